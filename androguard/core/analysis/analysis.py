@@ -11,21 +11,25 @@
 #
 #      http://www.apache.org/licenses/LICENSE-2.0
 
-import re, random, cPickle, collections
-from androguard.core.androconf import error, warning, debug, \
-    is_ascii_problem, load_api_specific_resource_module, framework_classes
+import re, random, cPickle, cStringIO, collections, bisect, heapq, multiprocessing
+from androguard.core.androconf import CONF, error, warning, debug, \
+    is_ascii_problem, load_api_specific_resource_module, get_framework_classes
 from androguard.core.bytecodes import dvm
+from androguard.core.analysis.icfg import CompactICFG
 
-from androguard.core.bytecodes.api_permissions import DVM_PERMISSIONS_BY_PERMISSION, \
-    DVM_PERMISSIONS_BY_ELEMENT
 import os
 
 
 class DVMBasicBlock(object):
     """
         A simple basic block of a dalvik method
+        (slotted: 152 bytes per block instead of 1112 with a __dict__)
     """
 
+    __slots__ = ('__vm', 'method', 'context', 'last_length', 'nb_instructions',
+                 'fathers', 'childs', 'start', 'end', 'special_ins', 'name',
+                 'exception_analysis', 'notes')
+
     def __init__(self, start, vm, method, context, framework_block=None):
         self.__vm = vm          # DalvikVMFormat
         self.method = method    # EncodedMethod
@@ -69,15 +73,9 @@ class DVMBasicBlock(object):
             Get all instructions from a basic block.
             :rtype: Return all instructions in the current basic block
         """
-        tmp_ins = []
-        idx = 0
         if not self.method:         # for test
             return self.name
-        for i in self.method.get_instructions():
-            if self.start <= idx < self.end:
-                tmp_ins.append(i)
-            idx += i.get_length()
-        return tmp_ins
+        return self.context.get_instructions(self.method, self.start, self.end)
 
     def get_instructions_output(self):
         ret = ""
@@ -308,14 +306,35 @@ class BasicBlocks(object):
     def __init__(self):
         self.bb = []
 
+        # start offsets of the blocks (rebuilt when blocks are added or removed)
+        self.__starts = None
+        self.__sorted = True
+
     def push(self, bb):
         self.bb.append(bb)
+        self.__starts = None
 
     def pop(self, idx):
+        self.__starts = None
         return self.bb.pop(idx)
 
     def get_basic_block(self, idx):
-        for i in self.bb:
+        if self.__starts is None or len(self.__starts) != len(self.bb):
+            self.__starts = [i.get_start() for i in self.bb]
+            self.__sorted = all(self.__starts[k] <= self.__starts[k + 1]
+                                for k in xrange(len(self.__starts) - 1))
+
+        if not self.__sorted:
+            for i in self.bb:
+                if i.get_start() <= idx < i.get_end():
+                    return i
+            return None
+
+        # the blocks of a method follow each other: only the last block
+        # starting before idx can contain it
+        pos = bisect.bisect_right(self.__starts, idx) - 1
+        if pos >= 0:
+            i = self.bb[pos]
             if i.get_start() <= idx < i.get_end():
                 return i
         return None
@@ -336,6 +355,48 @@ class BasicBlocks(object):
     def get_basic_block_pos(self, idx):
         return self.bb[idx]
 
+    # the instructions of the last method cut into blocks, and their offsets:
+    # the blocks of a method are walked one after the other, the method is
+    # decoded once for all its blocks without keeping every method decoded
+    __last_method = (None, None, None, None)
+    __last_instructions = ([], [])
+
+    def get_instructions(self, method, start, end):
+        """
+            Return the instructions of a method between two offsets
+
+            :param method: the method
+            :type method: :class:`EncodedMethod` object
+            :param start: the offset of the first instruction
+            :type start: int
+            :param end: the offset after the last instruction
+            :type end: int
+
+            :rtype: a list of :class:`Instruction` objects
+        """
+        code = method.get_code()
+        if code is None:
+            return []
+
+        # a new buffer (set_insn, set_idx) or new instructions (set_instructions)
+        # is a new decoding
+        bc = code.get_bc()
+        last_method, last_insn, last_idx, last_cached = BasicBlocks.__last_method
+        if last_method is not method or last_insn is not bc.insn or last_idx != bc.idx or \
+                last_cached is not bc.cached_instructions:
+            instructions = []
+            offsets = []
+            idx = 0
+            for i in method.get_instructions():
+                instructions.append(i)
+                offsets.append(idx)
+                idx += i.get_length()
+            BasicBlocks.__last_method = (method, bc.insn, bc.idx, bc.cached_instructions)
+            BasicBlocks.__last_instructions = (instructions, offsets)
+
+        instructions, offsets = BasicBlocks.__last_instructions
+        return instructions[bisect.bisect_left(offsets, start):bisect.bisect_left(offsets, end)]
+
 
 class ExceptionAnalysis(object):
 
@@ -388,6 +449,52 @@ class Exceptions(object):
 
         return None
 
+    def set_exception_analysis(self, basic_blocks):
+        """
+            Setup the exception analysis of all the basic blocks in one sweep,
+            with the same result as get_exception(bb.start, bb.end - 1) for
+            each block: the first try range which is inside the block or
+            which contains the block
+        """
+        blocks = sorted(basic_blocks.get(), key=lambda bb: (bb.start, bb.end))
+
+        # the heap below relies on non decreasing block ends, which is true
+        # for the disjoint blocks of a method
+        for prev, bb in zip(blocks, blocks[1:]):
+            if bb.end < prev.end:
+                for i in blocks:
+                    i.set_exception_analysis(self.get_exception(i.start,
+                                                                i.end - 1))
+                return
+
+        by_start = sorted(xrange(len(self.exceptions)),
+                          key=lambda n: self.exceptions[n].start)
+        starts = [self.exceptions[n].start for n in by_start]
+
+        active = []
+        pos = 0
+        for bb in blocks:
+            addr_start, addr_end = bb.start, bb.end - 1
+
+            # try ranges which start before the block, and so may contain it
+            while pos < len(by_start) and starts[pos] <= addr_start:
+                heapq.heappush(active, by_start[pos])
+                pos += 1
+            while active and self.exceptions[active[0]].end < addr_end:
+                heapq.heappop(active)
+            found = active[0] if active else None
+
+            # try ranges which are inside the block
+            n = bisect.bisect_left(starts, addr_start)
+            while n < len(starts) and starts[n] <= addr_end:
+                i = self.exceptions[by_start[n]]
+                if i.end <= addr_end and (found is None or by_start[n] < found):
+                    found = by_start[n]
+                n += 1
+
+            bb.set_exception_analysis(None if found is None else
+                                      self.exceptions[found])
+
     def gets(self):
         return self.exceptions
 
@@ -401,6 +508,35 @@ for i in dvm.BRANCH_DVM_OPCODES:
     BasicOPCODES.append(re.compile(i))
 
 
+def _branch_opcodes():
+    """
+        Return the opcode values whose instruction name matches BasicOPCODES,
+        so that a branch is found with one lookup instead of a regex per name
+    """
+    opcodes = set()
+    # same tables as Instruction.get_name
+    for table, keep in ((dvm.DALVIK_OPCODES_FORMAT, lambda op: op <= 0xff),
+                        (dvm.DALVIK_OPCODES_EXTENDED_WIDTH, lambda op: 0xff < op < 0xf2ff),
+                        (dvm.DALVIK_OPCODES_OPTIMIZED, lambda op: op >= 0xf2ff)):
+        for op_value, v in table.items():
+            if keep(op_value) and any(j.match(v[1][0]) for j in BasicOPCODES):
+                opcodes.add(op_value)
+    return frozenset(opcodes)
+
+BRANCH_OPCODES = _branch_opcodes()
+
+
+def is_branch(i):
+    """
+        Return True if the instruction ends a basic block (throw, if, goto,
+        return or switch)
+
+        :param i: an :class:`Instruction` object
+    """
+    # an invalid instruction keeps its opcode but has no branch name
+    return i.get_op_value() in BRANCH_OPCODES and not isinstance(i, dvm.InstructionInvalid)
+
+
 class MethodAnalysis(object):
     """
         This class analyses in details a method of a class/dex file
@@ -409,18 +545,36 @@ class MethodAnalysis(object):
         :type method: a :class:`EncodedMethod` object
     """
 
-    def __init__(self, vm, method):
+    def __init__(self, vm, method, layout=None, instructions=None, branches=None):
         self.__vm = vm              # DalvikVMFormat
         self.method = method        # EncodedMethod
 
         self.basic_blocks = BasicBlocks()
         self.exceptions = Exceptions()
         self.frame_blocks = BasicBlocks()
+        # signature -> stub block of a called framework method
+        self.__frame_blocks = {}
 
         code = self.method.get_code()   # code:DalvikCode
         if code is None:
             return
 
+        if layout is None:
+            excepts = self.__create_basic_blocks(code, instructions, branches)
+        else:
+            # blocks computed by another process (see get_layout)
+            excepts = dvm.determine_exception(self.__vm, self.method)
+            self.__load_layout(layout)
+
+        debug('Creating exceptions')
+
+        # Create exceptions
+        self.exceptions.add(excepts, self.basic_blocks)
+
+        # setup exception by basic block
+        self.exceptions.set_exception_analysis(self.basic_blocks)
+
+    def __create_basic_blocks(self, code, instructions=None, branches=None):
         #################################################
         # intro-procedural control flow construction
         ################################################
@@ -430,28 +584,34 @@ class MethodAnalysis(object):
 
         # bc is 'DCode' object
         bc = code.get_bc()
-        l = []
-        h = {}
+        l = set()       # the leaders: destinations of a branch or an exception
+        h = {}          # branch offset -> destinations
         idx = 0
 
         debug('Parsing instructions')
-        instructions = [i for i in bc.get_instructions()]
-        for i in instructions:          # i : 'Instruction'
-            for j in BasicOPCODES:      # branch
-                if j.match(i.get_name()) is not None:
+        if instructions is None:
+            instructions = [i for i in bc.get_instructions()]
+
+        if branches is not None:
+            # already found by NewVmAnalysis.analyze
+            h = branches
+            for v in h.itervalues():
+                l.update(v)
+        else:
+            for i in instructions:          # i : 'Instruction'
+                if is_branch(i):
                     v = dvm.determine_next(i, idx, self.method)
                     h[idx] = v
-                    l.extend(v)
-                    break
+                    l.update(v)
 
-            idx += i.get_length()
+                idx += i.get_length()
 
         debug('Parsing exceptions')
         excepts = dvm.determine_exception(self.__vm, self.method)
         for i in excepts:
-            l.extend([i[0]])
+            l.add(i[0])
             for handler in i[2:]:
-                l.append(handler[1])
+                l.add(handler[1])
 
         debug("Creating basic blocks in %s" % self.method)
         idx = 0
@@ -486,18 +646,42 @@ class MethodAnalysis(object):
             except KeyError:
                 i.set_childs([])
 
-        debug('Creating exceptions')
+        del instructions
+        del h, l
 
-        # Create exceptions
-        self.exceptions.add(excepts, self.basic_blocks)
+        return excepts
 
-        for i in self.basic_blocks.get():
-            # setup exception by basic block
-            i.set_exception_analysis(self.exceptions.get_exception(i.start,
-                                                                   i.end - 1))
+    def get_layout(self):
+        """
+            Return the basic blocks and their intra-procedural edges as plain
+            tuples, which can be pickled and given back as the layout
+            parameter of another MethodAnalysis of the same method
 
-        del instructions
-        del h, l
+            :rtype: a tuple (blocks, edges)
+        """
+        bbs = self.basic_blocks.gets()
+        index = dict((id(b), n) for n, b in enumerate(bbs))
+
+        blocks = [(b.start, b.end, b.last_length, b.nb_instructions, b.special_ins) for b in bbs]
+        edges = [(n, c[0], c[1], index[id(c[2])])
+                 for n, b in enumerate(bbs) for c in b.childs if c[3] == 'intra']
+        return blocks, edges
+
+    def __load_layout(self, layout):
+        blocks, edges = layout
+
+        for start, end, last_length, nb_instructions, special_ins in blocks:
+            bb = DVMBasicBlock(start, self.__vm, self.method, self.basic_blocks)
+            bb.end = end
+            bb.last_length = last_length
+            bb.nb_instructions = nb_instructions
+            bb.special_ins = special_ins
+            self.basic_blocks.push(bb)
+
+        bbs = self.basic_blocks.gets()
+        for n, from_off, to_off, m in edges:
+            bbs[n].childs.append((from_off, to_off, bbs[m], 'intra'))
+            bbs[m].set_fathers((to_off, from_off, bbs[n], 'intra'))
 
     def method_call(self, off, method_analysis):
         from_block = self.basic_blocks.get_basic_block(off)
@@ -507,29 +691,29 @@ class MethodAnalysis(object):
 
     def method_call_framework(self, off, class_name, method_name, method_discriptor):
         from_block = self.basic_blocks.get_basic_block(off)
-        to_block = DVMBasicBlock(0, None, None, None, class_name + method_name + method_discriptor)
-        self.frame_blocks.bb.append(to_block)
+        to_block = self.get_frame_block(class_name, method_name, method_discriptor)
+        if to_block is None:
+            # one stub per called framework method
+            to_block = DVMBasicBlock(0, None, None, None, class_name + method_name + method_discriptor)
+            self.frame_blocks.push(to_block)
+            self.__frame_blocks[class_name + method_name + method_discriptor] = to_block
         if from_block and to_block:
             from_block.set_child(to_block)
 
     def framework_call_method(self, method_analysis, class_name, method_name, method_disciptor):
-        to_blcok = method_analysis.basic_blocks.get_basic_block(0)
+        to_block = method_analysis.basic_blocks.get_basic_block(0)
         from_block = self.get_frame_block(class_name, method_name, method_disciptor)
         if from_block and to_block:
-            from_block.set_child(to_blcok)
+            from_block.set_child(to_block)
 
     def framework_call_method_tmp(self, method_analysis, class_name, method_name, method_disciptor):
-        to_blcok = method_analysis.basic_blocks.get_basic_block(0)
+        to_block = method_analysis.basic_blocks.get_basic_block(0)
         from_block = self.get_frame_block(class_name, method_name, method_disciptor)
         if from_block and to_block:
-            from_block.set_child_tmp(to_blcok)
-
+            from_block.set_child_tmp(to_block)
 
     def get_frame_block(self, class_name, method_name, method_discriptor):
-        sig = class_name + method_name + method_discriptor
-        for block in self.frame_blocks.bb:
-            if block.name == sig + '0x0000':
-                return block
+        return self.__frame_blocks.get(class_name + method_name + method_discriptor)
 
     def get_basic_blocks(self):
         """
@@ -751,16 +935,130 @@ class ClassAnalysis(object):
         return data
 
 
+class ClassHierarchy(object):
+    """
+        The superclass links of the classes of all the dex files of an
+        application, with the ancestors of each class computed once
+
+        :param vms: a list of :class:`DalvikVMFormat` objects
+        :param framework_classes: a :class:`FrameworkClasses` object
+    """
+
+    def __init__(self, vms, framework_classes):
+        self.framework_classes = framework_classes
+
+        self.__classes = {}
+        for vm in vms:
+            for current_class in vm.get_classes():
+                # the first definition wins, like in NewVmAnalysis.classes
+                if current_class.get_name() not in self.__classes:
+                    self.__classes[current_class.get_name()] = current_class
+
+        self.__ancestors = {}
+
+    def get_class(self, class_name):
+        """
+            :rtype: the :class:`ClassDefItem` object of a class of any dex file, or None
+        """
+        return self.__classes.get(class_name)
+
+    def get_superclass(self, class_name):
+        """
+            :rtype: the name of the superclass of a class of any dex file, or None
+        """
+        current_class = self.__classes.get(class_name)
+        if current_class is None:
+            return None
+        return current_class.sname
+
+    def get_ancestors(self, class_name):
+        """
+            Return the class and its superclasses, up to the first framework
+            class (except Landroid/support) or the first unknown class
+
+            :rtype: a frozenset of class names
+        """
+        try:
+            return self.__ancestors[class_name]
+        except KeyError:
+            pass
+
+        chain = []
+        seen = set()
+        ancestors = frozenset()
+        while class_name not in seen:
+            if class_name in self.__ancestors:
+                ancestors = self.__ancestors[class_name]
+                break
+            seen.add(class_name)
+            chain.append(class_name)
+            if self.framework_classes.is_framework_class(class_name) and \
+                    class_name.find("Landroid/support") == -1:
+                break
+            if class_name not in self.__classes:
+                break
+            class_name = self.__classes[class_name].sname
+
+        for name in reversed(chain):
+            ancestors = ancestors | frozenset([name])
+            self.__ancestors[name] = ancestors
+        return ancestors
+
+    def is_subclass(self, class_name, ancestor_name):
+        return ancestor_name in self.get_ancestors(class_name)
+
+
+# number of methods sent to a worker at once by intro_procedural_cfg
+POOL_CHUNK_SIZE = 64
+
+# the (vm, methods) analysed by the workers of intro_procedural_cfg
+_pool_methods = None
+
+
+def _create_layouts(task):
+    vm_idx, start, end = task
+    vm, methods = _pool_methods[vm_idx]
+    return vm_idx, start, [MethodAnalysis(vm, methods[i]).get_layout() for i in xrange(start, end)]
+
+
+class BytecodeScan(object):
+    """
+        The state of NewVmAnalysis.analyze, given to the instruction handlers
+    """
+
+    def __init__(self):
+        self.vm = None                  # DalvikVMFormat
+        self.current_class = None       # ClassDefItem
+        self.current_method = None      # EncodedMethod
+        self.cfg = False                # the cfg of the current class is built
+        self.blocks = False             # the blocks of the current class are built by this pass
+        self.xref = False               # the xrefs of the current class are created
+        self.branches = {}              # branch offset -> destinations, in the current method
+        self.calls = []                 # (vm, class, method, offset, method_info) of the invokes
+
+
+XREF_OPCODES = frozenset([0x1a, 0x1b, 0x1c, 0x22] + range(0x52, 0x6e) + range(0x6e, 0x73) + range(0x74, 0x79))
+
+
 class NewVmAnalysis(object):
 
-    def __init__(self, vm):
+    def __init__(self, vm, framework_classes=None):
 
         self.vms = [vm]
         self.classes = {}
         self.strings = {}
         self.methods = {}
-        self.framework_classes = framework_classes
+        # the package prefixes of the classes which are not analysed
+        self.framework_classes = get_framework_classes(framework_classes)
         self.framework_hierarchy_childs = {}
+        self.hierarchy = None
+        vm.add_class_cache_callback(self.reset_class_hierarchy)
+
+        # opcode -> handlers called by analyze
+        self.handlers = {}
+        self.register_handler(BRANCH_OPCODES, self.__scan_branch)
+        self.register_handler(dvm.INVOKE_OPCODES, self.__scan_invoke)
+        self.register_handler(XREF_OPCODES, self.__scan_xref)
         # self.framework_hierarchy_parents = {}
 
         # self.class_hierarchy_framework = {}
@@ -780,12 +1078,7 @@ class NewVmAnalysis(object):
     def get_class_nums(self):
         ret = 0
         for current_class in self.classes.keys():
-            framework_class = False
-            for framework in self.framework_classes:
-                if current_class.find(framework) != -1:
-                    framework_class = True
-                    break
-            if framework_class:
+            if self.framework_class(current_class):
                 continue
             ret += 1
         return ret
@@ -802,17 +1095,189 @@ class NewVmAnalysis(object):
             ret += len(vm.get_methods_with_framework_class())
         return ret
 
-    def intro_procedural_cfg(self):
+    def register_handler(self, op_values, handler):
+        """
+            Register a function called by analyze for each instruction with
+            one of these opcodes
+
+            :param op_values: a list of opcode values
+            :param handler: a function (scan, instruction, off) where scan is
+                            the :class:`BytecodeScan` object of the analysis
+        """
+        for op_value in op_values:
+            self.handlers.setdefault(op_value, []).append(handler)
+
+    def analyze(self, cfg=True, xref=True, registration_callback=None, processes=None):
+        """
+            Build the cfg and the icfg and create the xrefs with one pass over
+            the instructions, which gives the same result as intro_procedural_cfg,
+            explicit_icfg, callback_icfg and create_xref one after the other
+
+            :param cfg: build the MethodAnalysis objects and the explicit icfg
+            :param xref: create the xrefs
+            :param registration_callback: registration method -> {position: callback method},
+                                          to add the callback edges (construct_class_hierarchy
+                                          must have been called)
+            :param processes: the number of processes which build the basic
+                              blocks (CONF["CFG_PROCESSES"] by default, 1: in
+                              this pass), as in intro_procedural_cfg
+        """
+        if processes is None:
+            processes = CONF["CFG_PROCESSES"]
+
+        # the workers build the blocks, this pass only records the invokes and the xrefs
+        pooled = cfg and processes > 1
+        if pooled:
+            self.__intro_procedural_cfg_pool(processes)
+
+        scan = BytecodeScan()
+        handlers = self.handlers
+
+        for vm in self.vms:
+            scan.vm = vm
+            for current_class in vm.get_classes():
+                scan.current_class = current_class
+                scan.cfg = cfg and not self.framework_class(current_class.name)
+                scan.blocks = scan.cfg and not pooled
+                scan.xref = xref and current_class.name.find("Landroid/support/") == -1
+                if not scan.cfg and not scan.xref:
+                    continue
+
+                for current_method in current_class.get_methods():
+                    code = current_method.get_code()
+                    if code is None:
+                        continue
+                    scan.current_method = current_method
+                    scan.branches = {}
+
+                    # the instructions are handled as they are decoded, so that
+                    # the xrefs before an invalid instruction are kept, as in create_xref
+                    instructions = []
+                    off = 0
+                    try:
+                        for instruction in code.get_bc().get_instructions():
+                            if scan.blocks:
+                                instructions.append(instruction)
+                            op_value = instruction.get_op_value()
+                            if op_value in handlers:
+                                for handler in handlers[op_value]:
+                                    handler(scan, instruction, off)
+                            off += instruction.get_length()
+                    except dvm.InvalidInstruction as e:
+                        if scan.cfg:
+                            raise
+                        warning("Invalid instruction %s" % str(e))
+                        continue
+
+                    if scan.blocks:
+                        self.methods[current_method] = MethodAnalysis(vm, current_method,
+                                                                      instructions=instructions,
+                                                                      branches=scan.branches)
+
+        # the called methods have their basic blocks now
+        for vm, current_class, current_method, off, method_info in scan.calls:
+            self.link_call(vm, current_method, off, method_info)
+
+        if registration_callback is not None:
+            hierarchy = self.get_class_hierarchy()
+            for vm, current_class, current_method, off, method_info in scan.calls:
+                self.link_callback(registration_callback, hierarchy, vm, current_class,
+                                   current_method, method_info)
+
+    def __scan_branch(self, scan, instruction, off):
+        if scan.blocks and is_branch(instruction):
+            scan.branches[off] = dvm.determine_next(instruction, off, scan.current_method)
+
+    def __scan_invoke(self, scan, instruction, off):
+        if scan.cfg:
+            scan.calls.append((scan.vm, scan.current_class, scan.current_method, off,
+                               scan.vm.get_cm_method(instruction.get_ref_kind())))
+
+    def __scan_xref(self, scan, instruction, off):
+        if scan.xref:
+            self.add_xref(scan.vm, scan.current_class, scan.current_method, instruction, off)
+
+    def intro_procedural_cfg(self, processes=None):
+        """
+            Build the MethodAnalysis of each method
+
+            :param processes: the number of processes which build the basic
+                              blocks (CONF["CFG_PROCESSES"] by default, 1: in
+                              this process)
+        """
+        if processes is None:
+            processes = CONF["CFG_PROCESSES"]
+
+        if processes > 1:
+            self.__intro_procedural_cfg_pool(processes)
+            return
+
         for vm in self.vms:
             for method in vm.get_methods(self.framework_classes):     # method : EncodedMethod
                 self.methods[method] = MethodAnalysis(vm, method)
 
-    def export_to_dot(self):
-        buff = "digraph CFG {\n"
-        # buff += self.generate_dot_edges_discription()
-        buff += self.generate_dot_edges()
-        buff += "\n}"
-        return buff
+    def __intro_procedural_cfg_pool(self, processes):
+        global _pool_methods
+
+        # the workers are forked: they inherit the parsed dex files and only
+        # send back the layout of the basic blocks of each method
+        _pool_methods = [(vm, vm.get_methods(self.framework_classes)) for vm in self.vms]
+        tasks = []
+        for vm_idx, (vm, methods) in enumerate(_pool_methods):
+            for start in xrange(0, len(methods), POOL_CHUNK_SIZE):
+                tasks.append((vm_idx, start, min(start + POOL_CHUNK_SIZE, len(methods))))
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            for vm_idx, start, layouts in pool.imap_unordered(_create_layouts, tasks):
+                vm, methods = _pool_methods[vm_idx]
+                for method, layout in zip(methods[start:], layouts):
+                    self.methods[method] = MethodAnalysis(vm, method, layout)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _pool_methods = None
+
+    def get_compact_icfg(self, release=False):
+        """
+            Return the inter-procedural control flow graph of the blocks in
+            compressed sparse row form, once the cfg and the icfg are built
+
+            :param release: drop the edges of the blocks as they are converted
+            :rtype: a :class:`CompactICFG` object
+        """
+        return CompactICFG.from_analysis(self, release)
+
+    def export_to_dot(self, graph=None):
+        """
+            :param graph: a :class:`CompactICFG` object to export instead of
+                          the blocks of this analysis
+        """
+        buff = cStringIO.StringIO()
+        self.write_dot(buff, graph)
+        return buff.getvalue()
+
+    def write_dot(self, f, graph=None):
+        """
+            Write the inter-procedural edges and the blocks in the dot format,
+            as they are found, to a file object (gzip.GzipFile for a
+            compressed output)
+
+            :param f: a file object
+            :param graph: a :class:`CompactICFG` object to export instead of
+                          the blocks of this analysis
+        """
+        if graph is not None:
+            graph.write_dot(f)
+            return
+
+        f.write("digraph CFG {\n")
+        # f.write(self.generate_dot_edges_discription())
+        self.write_dot_edges(f)
+        f.write("\n}")
 
     def generate_dot_edges_discription(self):
         buff = ""
@@ -853,149 +1318,116 @@ class NewVmAnalysis(object):
         return buff
 
     def generate_dot_edges(self):
-        buff = ""
-        dots = set()
+        buff = cStringIO.StringIO()
+        self.write_dot_edges(buff)
+        return buff.getvalue()
+
+    def write_dot_edges(self, f):
+        # block name -> quoted name, in the order of the first use: each name
+        # is formatted once, and written once as a node
+        dots = collections.OrderedDict()
         edges = 0
 
+        def quote(name):
+            try:
+                return dots[name]
+            except KeyError:
+                dot = dots[name] = '"%s"' % name
+                return dot
+
         for vm in self.vms:
             for method in vm.get_methods(self.framework_classes):     # method : EncodedMethod
                 g = self.methods[method]
-                for i in g.basic_blocks.get():
-                    instructions_begin = i.name
-                    dots.add(i.name)
-                    for j in i.childs:
-                        if j[3] == 'inter':
-                            dots.add(j[2].name)
-                            instructions_end = j[2].name
-                            buff += '"' + instructions_begin + '"' + ' -> '
-                            buff += '"' + instructions_end + '"'
-                            buff += '\n'
-                            edges += 1
-                for i in g.frame_blocks.get():
-                    instructions_begin = i.name
-                    dots.add(i.name)
-                    for j in i.childs:
-                        if j[3] == 'inter':
-                            dots.add(j[2].name)
-                            instructions_end = j[2].name
-                            buff += '"' + instructions_begin + '"' + ' -> '
-                            buff += '"' + instructions_end + '"'
-                            buff += '\n'
-                            edges += 1
+                for blocks in (g.basic_blocks, g.frame_blocks):
+                    for i in blocks.get():
+                        instructions_begin = quote(i.name)
+                        for j in i.childs:
+                            if j[3] == 'inter':
+                                f.write(instructions_begin + ' -> ' + quote(j[2].name) + '\n')
+                                edges += 1
 
-            for block in dots:
-                    buff += '"' + block + '"' + '\n'
+        for dot in dots.itervalues():
+            f.write(dot + '\n')
 
-
-        '''
-        for current_class in self.classes.keys():
-            current_class_analysis = self.classes[current_class]
-            for method in current_class_analysis.methods.keys():    # method -> EncodedMethod
-                class_method_analysis = current_class_analysis.methods[method]
-                for obj, met, off in class_method_analysis.xrefto:
-                    if method.get_class_name().find("Landroid/support/") != -1 and met.get_class_name().find("Landroid/support/") != -1:
-                        continue
-                    m1 = method.get_class_name() + method.get_name() + method.get_descriptor()
-                    m2 = met.get_class_name() + met.get_name() + met.get_descriptor()
-                    dots.add(m1)
-                    dots.add(m2)
-                    buff += '"' + m1 + '"' + ' -> '
-                    buff += '"' + m2 + '"'
-                    buff += '\n'
-                    edges += 1
-        '''
-
-        print "dots number: %d", len(dots)
-        print "edges numbers: %d", edges
-        return buff
+        debug("dots number: %d" % len(dots))
+        debug("edges numbers: %d" % edges)
 
     def framework_class(self, class_name):
-        for framework_class in self.framework_classes:
-            if class_name.find(framework_class) == 0:
-                return True
-        return False
+        return self.framework_classes.is_framework_class(class_name)
 
     def explicit_icfg(self):
         #####################################################
         # explicit inter-procedural control flow construction
         #####################################################
         for vm in self.vms:
-            for current_class in vm.get_classes():
-                # 如果当前类是框架类,则直接跳过
-                if self.framework_class(current_class.name):
-                    continue
-                for current_method in current_class.get_methods():
-                    code = current_method.get_code()
-                    if code is None:
-                        continue
-                    off = 0
-                    bc = code.get_bc()
-                    try:
-                        for instruction in bc.get_instructions():
-                            op_value = instruction.get_op_value()
-                            # invoke-kind /range {vC, vD, vE, vF, vG}, meth@BBBB
-                            if(0x6e <= op_value <= 0x72) or (0x74 <= op_value <= 0x78) or (0x22ff <= op_value <= 0x26ff):
-                                # print instruction.get_output()
-                                idx_meth = instruction.get_ref_kind()
-                                method_info = vm.get_cm_method(idx_meth)
-                                if method_info:
-                                    # 如果调用的是框架层的代码
-
-                                    if self.framework_class(method_info[0]):
-                                        self.methods[current_method].method_call_framework(off, method_info[0],
-                                                                                           method_info[1],
-                                                                                           "".join(method_info[2]))
-                                    else:
-                                        destinate_class = method_info[0]
-                                        destinate_method_name = method_info[1]
-                                        destinate_method_discription = ''.join(method_info[2])
-                                        # 代码中没有找到这样的调用函数
-                                        if not vm.get_method_descriptor(destinate_class, destinate_method_name, destinate_method_discription):
-                                            continue
-                                            while not vm.get_method_descriptor(destinate_class, destinate_method_name, destinate_method_discription):
-                                                if self.framework_class(destinate_class):
-                                                    self.methods[current_method].method_call_framework(off, destinate_class,
-                                                                                                       destinate_method_name,
-                                                                                                       destinate_method_discription)
-                                                    break
-                                                else:
-                                                    try:
-                                                        destinate_class = vm.get_class(destinate_class).sname
-                                                    except:
-                                                        # print destinate_class
-                                                        break
-
-                                            # 当前的非框架类有这样的框架函数调用
-                                            if not self.framework_class(destinate_class):
-                                                self.methods[current_method].method_call_framework(off, destinate_class, destinate_method_name, destinate_method_discription)
-                                        else:
-                                            method_encode = vm.get_method_descriptor(destinate_class, destinate_method_name, destinate_method_discription)
-                                            # 考虑多态
-                                            self.methods[current_method].method_call(off, self.methods[method_encode])
-                                            '''
-                                            org = [destinate_class]
-                                            self.methods[current_method].method_call(off, self.methods[method_encode])
-                                            while org:
-                                                dst = []
-                                                for c in org:
-                                                    cur_class = vm.get_class(c)
-                                                    if cur_class.childs_class_name:
-                                                        for child_class in cur_class.childs_class_name:
-                                                            method_encode = vm.get_method_descriptor(child_class, destinate_method_name, destinate_method_discription)
-                                                            if method_encode:
-                                                                self.methods[current_method].method_call(off, self.methods[method_encode])
-                                                                dst.append(child_class)
-                                                org = dst
-                                            '''
-
-                                else:
-                                    pass
-                                    # print 'do not find the specific method in smali. can not be here. '
-                                    # exit('Look the bugs here in explicit_icfg construction')
+            # the methods of the framework classes are skipped (and not decoded)
+            methods = vm.get_methods(self.framework_classes)
+            for current_method, off, idx_meth, op_value in vm.get_call_sites().gets(methods):
+                self.link_call(vm, current_method, off, vm.get_cm_method(idx_meth))
 
-                            off += instruction.get_length()
-                    except dvm.InvalidInstruction as e:
-                        warning("Invalid instruction %s" % str(e))
+    def link_call(self, vm, current_method, off, method_info):
+        """
+            Add the inter-procedural edge of an invoke instruction
+
+            :param vm: the :class:`DalvikVMFormat` object of the current method
+            :param current_method: the :class:`EncodedMethod` object which calls
+            :param off: the offset of the invoke instruction
+            :param method_info: the called method, as returned by vm.get_cm_method
+        """
+        if method_info:
+            # 如果调用的是框架层的代码
+
+            if self.framework_class(method_info[0]):
+                self.methods[current_method].method_call_framework(off, method_info[0],
+                                                                   method_info[1],
+                                                                   "".join(method_info[2]))
+            else:
+                destinate_class = method_info[0]
+                destinate_method_name = method_info[1]
+                destinate_method_discription = ''.join(method_info[2])
+                # 代码中没有找到这样的调用函数
+                if not vm.get_method_descriptor(destinate_class, destinate_method_name, destinate_method_discription):
+                    return
+                    while not vm.get_method_descriptor(destinate_class, destinate_method_name, destinate_method_discription):
+                        if self.framework_class(destinate_class):
+                            self.methods[current_method].method_call_framework(off, destinate_class,
+                                                                               destinate_method_name,
+                                                                               destinate_method_discription)
+                            break
+                        else:
+                            try:
+                                destinate_class = vm.get_class(destinate_class).sname
+                            except:
+                                # print destinate_class
+                                break
+
+                    # 当前的非框架类有这样的框架函数调用
+                    if not self.framework_class(destinate_class):
+                        self.methods[current_method].method_call_framework(off, destinate_class, destinate_method_name, destinate_method_discription)
+                else:
+                    method_encode = vm.get_method_descriptor(destinate_class, destinate_method_name, destinate_method_discription)
+                    # 考虑多态
+                    self.methods[current_method].method_call(off, self.methods[method_encode])
+                    '''
+                    org = [destinate_class]
+                    self.methods[current_method].method_call(off, self.methods[method_encode])
+                    while org:
+                        dst = []
+                        for c in org:
+                            cur_class = vm.get_class(c)
+                            if cur_class.childs_class_name:
+                                for child_class in cur_class.childs_class_name:
+                                    method_encode = vm.get_method_descriptor(child_class, destinate_method_name, destinate_method_discription)
+                                    if method_encode:
+                                        self.methods[current_method].method_call(off, self.methods[method_encode])
+                                        dst.append(child_class)
+                        org = dst
+                    '''
+
+        else:
+            pass
+            # print 'do not find the specific method in smali. can not be here. '
+            # exit('Look the bugs here in explicit_icfg construction')
 
     def implicit_icfg(self, registration_callback):
         self.lifecycle_icfg()
@@ -1017,82 +1449,80 @@ class NewVmAnalysis(object):
                     self.content_provider_lifecycle(current_class, vm)
 
     def callback_icfg(self, registration_callback):
+        hierarchy = self.get_class_hierarchy()
         for vm in self.vms:
-            for current_class in vm.get_classes():
-                if self.framework_class(current_class.name):
-                    continue
-                for current_method in current_class.get_methods():
-                    code = current_method.get_code()
-                    if code is None:
-                        continue
-                    off = 0
-                    bc = code.get_bc()
-                    try:
-                        for instruction in bc.get_instructions():
-                            op_value = instruction.get_op_value()
-                            # invoke-kind /range {vC, vD, vE, vF, vG}, meth@BBBB
-                            if(0x6e <= op_value <= 0x72) or (0x74 <= op_value <= 0x78) or (0x22ff <= op_value <= 0x26ff):
-                                idx_meth = instruction.get_ref_kind()
-                                method_info = vm.get_cm_method(idx_meth)
-                                if method_info:
-                                    from_class = method_info[0]
-                                    from_method_name = method_info[1]
-                                    from_method_discription = ''.join(method_info[2])
-
-                                    while (from_class + '->' + from_method_name + from_method_discription) not in registration_callback.keys():
-                                        if self.framework_class(from_class) and from_class.find("Landroid/support") == -1:
-                                            try:
-                                                from_class = class_hierarchy_framework[from_class[:-1] + '.java']['parents'][0]
-                                                from_class = from_class[:-5] + ';'
-                                            except:
-                                                break
-                                        else:
-                                            try:
-                                                from_class = vm.get_class(from_class).sname
-                                            except:
-                                                break
-
-                                    signture = from_class + '->'+ from_method_name + from_method_discription
-                                    # 如果存在这样的registration函数
-                                    if signture in registration_callback.keys():
-                                        reg = registration_callback[signture]
-                                        for position in reg.keys():
-                                            may_callback = reg[position]
-                                            p1 = may_callback.find("->")
-                                            p2 = may_callback.find("(")
-                                            may_func = may_callback[p1+2:p2]
-
-                                            if position == "0":
-                                                # 当前类中存在着对应的回调函数
-                                                method_encode = vm.get_method_descriptor(current_class.name, may_func, may_callback[p2:])
-                                                if method_encode:
-                                                    try:
-                                                        self.methods[current_method].framework_call_method_tmp(self.methods[method_encode], method_info[0], method_info[1], ''.join(method_info[2]),)
-                                                    except:
-                                                        pass
-                                                        # print method_info[0] + method_info[1] + ''.join(method_info[2])
-                                            else:
-                                                may_class = 'L' + may_callback[:p1]
-                                                # print may_class
-                                                if may_class in self.framework_hierarchy_childs.keys():
-                                                    childs = self.framework_hierarchy_childs[may_class]
-                                                    if childs:
-                                                        dst = []
-                                                        for child in childs:
-                                                            method_encode = vm.get_method_descriptor(child, may_func, may_callback[p2:])
-                                                            if method_encode:
-                                                                try:
-                                                                    self.methods[current_method].framework_call_method_tmp(self.methods[method_encode], method_info[0], method_info[1], ''.join(method_info[2]))
-                                                                except:
-                                                                    pass
-                                                            else:
-                                                                if child in self.framework_hierarchy_childs.keys():
-                                                                    dst.append(child)
-                                                        # childs = dst
+            methods = vm.get_methods(self.framework_classes)
+            for current_method, off, idx_meth, op_value in vm.get_call_sites().gets(methods):
+                class_name = current_method.get_class_name()
+                self.link_callback(registration_callback, hierarchy, vm, vm.get_class(class_name),
+                                   current_method, vm.get_cm_method(idx_meth))
 
-                            off += instruction.get_length()
-                    except dvm.InvalidInstruction as e:
-                        warning("Invalid instruction %s" % str(e))
+    def link_callback(self, registration_callback, hierarchy, vm, current_class, current_method, method_info):
+        """
+            Add the callback edges of an invoke instruction which registers a
+            callback
+
+            :param registration_callback: registration method -> {position: callback method}
+            :param hierarchy: the :class:`ClassHierarchy` object of the dex files
+            :param vm: the :class:`DalvikVMFormat` object of the current method
+            :param current_class: the :class:`ClassDefItem` object of the current method
+            :param current_method: the :class:`EncodedMethod` object which calls
+            :param method_info: the called method, as returned by vm.get_cm_method
+        """
+        if method_info:
+            from_class = method_info[0]
+            from_method_name = method_info[1]
+            from_method_discription = ''.join(method_info[2])
+
+            while (from_class + '->' + from_method_name + from_method_discription) not in registration_callback.keys():
+                if self.framework_class(from_class) and from_class.find("Landroid/support") == -1:
+                    try:
+                        from_class = class_hierarchy_framework[from_class[:-1] + '.java']['parents'][0]
+                        from_class = from_class[:-5] + ';'
+                    except:
+                        break
+                else:
+                    from_class = hierarchy.get_superclass(from_class)
+                    if from_class is None:
+                        break
+
+            signture = from_class + '->'+ from_method_name + from_method_discription
+            # 如果存在这样的registration函数
+            if signture in registration_callback.keys():
+                reg = registration_callback[signture]
+                for position in reg.keys():
+                    may_callback = reg[position]
+                    p1 = may_callback.find("->")
+                    p2 = may_callback.find("(")
+                    may_func = may_callback[p1+2:p2]
+
+                    if position == "0":
+                        # 当前类中存在着对应的回调函数
+                        method_encode = vm.get_method_descriptor(current_class.name, may_func, may_callback[p2:])
+                        if method_encode:
+                            try:
+                                self.methods[current_method].framework_call_method_tmp(self.methods[method_encode], method_info[0], method_info[1], ''.join(method_info[2]),)
+                            except:
+                                pass
+                                # print method_info[0] + method_info[1] + ''.join(method_info[2])
+                    else:
+                        may_class = 'L' + may_callback[:p1]
+                        # print may_class
+                        if may_class in self.framework_hierarchy_childs.keys():
+                            childs = self.framework_hierarchy_childs[may_class]
+                            if childs:
+                                dst = []
+                                for child in childs:
+                                    method_encode = vm.get_method_descriptor(child, may_func, may_callback[p2:])
+                                    if method_encode:
+                                        try:
+                                            self.methods[current_method].framework_call_method_tmp(self.methods[method_encode], method_info[0], method_info[1], ''.join(method_info[2]))
+                                        except:
+                                            pass
+                                    else:
+                                        if child in self.framework_hierarchy_childs.keys():
+                                            dst.append(child)
+                                # childs = dst
 
     def activity_lifecycle(self, current_class, vm):
         pass
@@ -1107,36 +1537,23 @@ class NewVmAnalysis(object):
         pass
 
     def activity_class(self, class_name, vm):
-        return self.ancestor_class(class_name, "Landroid/app/Activity", vm)
+        return self.ancestor_class(class_name, "Landroid/app/Activity;", vm)
 
     def service_class(self, class_name, vm):
-        return self.ancestor_class(class_name, "Landroid.app.Service", vm)
+        return self.ancestor_class(class_name, "Landroid/app/Service;", vm)
 
     def broadcast_receiver_class(self, class_name, vm):
-        return self.ancestor_class(class_name, "Landroid/content/BroadcastReceiver", vm)
+        return self.ancestor_class(class_name, "Landroid/content/BroadcastReceiver;", vm)
 
     def content_provider_class(self, class_name, vm):
-        return self.ancestor_class(class_name, "Landroid.content.ContentProvider", vm)
+        return self.ancestor_class(class_name, "Landroid/content/ContentProvider;", vm)
 
     def application_class(self, class_name, vm):
-        return self.ancestor_class(class_name, "android.app.Application", vm)
-
-    def ancestor_class(self, class_name, ancestor_name, vm):
-        while class_name != ancestor_name:
-            if self.framework_class(class_name):
-                if class_name.find("Landroid/support") != -1:
-                    if vm.get_class(class_name):
-                        class_name = vm.get_class(class_name).sname
-                    else:
-                        return False
-                else:
-                    return False
-            else:
-                if vm.get_class(class_name):
-                    class_name = vm.get_class(class_name).sname
-                else:
-                    return False
-        return True
+        return self.ancestor_class(class_name, "Landroid/app/Application;", vm)
+
+    def ancestor_class(self, class_name, ancestor_name, vm=None):
+        # the superclass may be defined in any dex file, not only in vm
+        return self.get_class_hierarchy().is_subclass(class_name, ancestor_name)
 
     # def find_corresponding_framework_class(self, class_name, vm):
     #     while not self.framework_class(class_name) or class_name.find("Landroid/support") != -1:
@@ -1144,8 +1561,6 @@ class NewVmAnalysis(object):
     #     return class_name
 
     def create_xref(self):
-        instances_class_name = self.classes.keys()
-
         for vm in self.vms:
             for current_class in vm.get_classes():
                 if current_class.name.find("Landroid/support/") != -1:
@@ -1158,101 +1573,114 @@ class NewVmAnalysis(object):
                     bc = code.get_bc()
                     try:
                         for instruction in bc.get_instructions():
-                            op_value = instruction.get_op_value()
-                            if op_value in [0x1c, 0x22]:
-                                idx_type = instruction.get_ref_kind()
-                                type_info = vm.get_cm_type(idx_type)
-                                # Internal class manipulation
-                                if type_info in instances_class_name and type_info != current_class.get_name():
-                                    # new-instance vAA, type@BBBB
-                                    if op_value == 0x22:
-                                        self.classes[current_class.get_name(
-                                        )].AddXrefTo(REF_NEW_INSTANCE,
-                                                     self.classes[type_info],
-                                                     current_method, off)
-                                        self.classes[type_info].AddXrefFrom(
-                                            REF_NEW_INSTANCE,
-                                            self.classes[current_class.get_name()],
-                                            current_method, off)
-                                    # const-class vAA, type@BBBB
-                                    else:
-                                        self.classes[current_class.get_name()].AddXrefTo(REF_CLASS_USAGE,
-                                                                                         self.classes[type_info],
-                                                                                         current_method, off)
-                                        self.classes[type_info].AddXrefFrom(REF_CLASS_USAGE,
-                                                                            self.classes[current_class.get_name()],
-                                                                            current_method, off)
-
-                            # invoke-kind /range {vC, vD, vE, vF, vG}, meth@BBBB
-                            elif (0x6e <= op_value <= 0x72) or (0x74 <= op_value <= 0x78):
-                                idx_meth = instruction.get_ref_kind()
-                                method_info = vm.get_cm_method(idx_meth)
-                                if method_info:
-                                    class_info = method_info[0]
-
-                                    method_item = vm.get_method_descriptor(
-                                        method_info[0], method_info[1],
-                                        ''.join(method_info[2]))
-                                    if method_item:
-                                        self.classes[current_class.get_name(
-                                        )].AddMXrefTo(current_method,
-                                                      self.classes[class_info],
-                                                      method_item, off)
-                                        self.classes[class_info].AddMXrefFrom(
-                                            method_item,
-                                            self.classes[current_class.get_name()],
-                                            current_method, off)
-
-                                        # Internal xref related to class manipulation
-                                        if class_info in instances_class_name and class_info != current_class.get_name(
-                                        ):
-                                            self.classes[current_class.get_name(
-                                            )].AddXrefTo(REF_CLASS_USAGE,
-                                                         self.classes[class_info],
-                                                         method_item, off)
-                                            self.classes[class_info].AddXrefFrom(
-                                                REF_CLASS_USAGE,
-                                                self.classes[current_class.get_name()],
-                                                current_method, off)
-
-                            # const-string/jumbo vAA, string@BBBB
-                            elif 0x1a <= op_value <= 0x1b:
-                                string_value = vm.get_cm_string(
-                                    instruction.get_ref_kind())
-                                if string_value not in self.strings:
-                                    self.strings[string_value] = StringAnalysis(
-                                        string_value)
-                                self.strings[string_value].AddXrefFrom(
-                                    self.classes[current_class.get_name()],
-                                    current_method)
-
-                            # sget, iget, sput, iput
-                            elif 0x52 <= op_value <= 0x6d:
-                                idx_field = instruction.get_ref_kind()
-                                field_info = vm.get_cm_field(idx_field)
-                                field_item = vm.get_field_descriptor(
-                                    field_info[0], field_info[2], field_info[1])
-                                if field_item:
-                                    # read access to a field
-                                    if (0x52 <= op_value <= 0x58) or (
-                                            0x60 <= op_value <= 0x66):
-                                        self.classes[current_class.get_name(
-                                        )].AddFXrefRead(
-                                            current_method,
-                                            self.classes[current_class.get_name()],
-                                            field_item)
-                                    # write access to a field
-                                    else:
-                                        self.classes[current_class.get_name(
-                                        )].AddFXrefWrite(
-                                            current_method,
-                                            self.classes[current_class.get_name()],
-                                            field_item)
+                            self.add_xref(vm, current_class, current_method, instruction, off)
 
                             off += instruction.get_length()
                     except dvm.InvalidInstruction as e:
                         warning("Invalid instruction %s" % str(e))
 
+    def add_xref(self, vm, current_class, current_method, instruction, off):
+        """
+            Add the xrefs of an instruction: new-instance, const-class,
+            invoke, const-string and field access
+
+            :param vm: the :class:`DalvikVMFormat` object of the current method
+            :param current_class: the :class:`ClassDefItem` object of the current method
+            :param current_method: the :class:`EncodedMethod` object of the instruction
+            :param instruction: an :class:`Instruction` object
+            :param off: the offset of the instruction
+        """
+        op_value = instruction.get_op_value()
+        if op_value in [0x1c, 0x22]:
+            idx_type = instruction.get_ref_kind()
+            type_info = vm.get_cm_type(idx_type)
+            # Internal class manipulation
+            if type_info in self.classes and type_info != current_class.get_name():
+                # new-instance vAA, type@BBBB
+                if op_value == 0x22:
+                    self.classes[current_class.get_name(
+                    )].AddXrefTo(REF_NEW_INSTANCE,
+                                 self.classes[type_info],
+                                 current_method, off)
+                    self.classes[type_info].AddXrefFrom(
+                        REF_NEW_INSTANCE,
+                        self.classes[current_class.get_name()],
+                        current_method, off)
+                # const-class vAA, type@BBBB
+                else:
+                    self.classes[current_class.get_name()].AddXrefTo(REF_CLASS_USAGE,
+                                                                     self.classes[type_info],
+                                                                     current_method, off)
+                    self.classes[type_info].AddXrefFrom(REF_CLASS_USAGE,
+                                                        self.classes[current_class.get_name()],
+                                                        current_method, off)
+
+        # invoke-kind /range {vC, vD, vE, vF, vG}, meth@BBBB
+        elif (0x6e <= op_value <= 0x72) or (0x74 <= op_value <= 0x78):
+            idx_meth = instruction.get_ref_kind()
+            method_info = vm.get_cm_method(idx_meth)
+            if method_info:
+                class_info = method_info[0]
+
+                method_item = vm.get_method_descriptor(
+                    method_info[0], method_info[1],
+                    ''.join(method_info[2]))
+                if method_item:
+                    self.classes[current_class.get_name(
+                    )].AddMXrefTo(current_method,
+                                  self.classes[class_info],
+                                  method_item, off)
+                    self.classes[class_info].AddMXrefFrom(
+                        method_item,
+                        self.classes[current_class.get_name()],
+                        current_method, off)
+
+                    # Internal xref related to class manipulation
+                    if class_info in self.classes and class_info != current_class.get_name(
+                    ):
+                        self.classes[current_class.get_name(
+                        )].AddXrefTo(REF_CLASS_USAGE,
+                                     self.classes[class_info],
+                                     method_item, off)
+                        self.classes[class_info].AddXrefFrom(
+                            REF_CLASS_USAGE,
+                            self.classes[current_class.get_name()],
+                            current_method, off)
+
+        # const-string/jumbo vAA, string@BBBB
+        elif 0x1a <= op_value <= 0x1b:
+            string_value = vm.get_cm_string(
+                instruction.get_ref_kind())
+            if string_value not in self.strings:
+                self.strings[string_value] = StringAnalysis(
+                    string_value)
+            self.strings[string_value].AddXrefFrom(
+                self.classes[current_class.get_name()],
+                current_method)
+
+        # sget, iget, sput, iput
+        elif 0x52 <= op_value <= 0x6d:
+            idx_field = instruction.get_ref_kind()
+            field_info = vm.get_cm_field(idx_field)
+            field_item = vm.get_field_descriptor(
+                field_info[0], field_info[2], field_info[1])
+            if field_item:
+                # read access to a field
+                if (0x52 <= op_value <= 0x58) or (
+                        0x60 <= op_value <= 0x66):
+                    self.classes[current_class.get_name(
+                    )].AddFXrefRead(
+                        current_method,
+                        self.classes[current_class.get_name()],
+                        field_item)
+                # write access to a field
+                else:
+                    self.classes[current_class.get_name(
+                    )].AddFXrefWrite(
+                        current_method,
+                        self.classes[current_class.get_name()],
+                        field_item)
+
     def get_method_novm(self, method):
         for vm in self.vms:
             if method in vm.get_methods():
@@ -1299,6 +1727,10 @@ class NewVmAnalysis(object):
 
     def add(self, vm):
         self.vms.append(vm)
+        self.reset_class_hierarchy()
+        vm.add_class_cache_callback(self.reset_class_hierarchy)
+        # one budget of decoded instructions for all the dex files
+        vm.CM.set_instructions_cache(self.vms[0].CM.get_instructions_cache())
 
         for current_class in vm.get_classes():
             if current_class.get_name() not in self.classes:
@@ -1307,10 +1739,35 @@ class NewVmAnalysis(object):
     def get_vms(self):
         return self.vms
 
+    def clear_instructions_cache(self):
+        """
+            Release the decoded instructions kept for the analysis passes
+        """
+        cache = self.vms[0].CM.get_instructions_cache()
+        if cache.is_enabled():
+            debug("instructions cache: %d hits, %d misses (hit rate %.2f%%)" % (
+                cache.hits, cache.misses, cache.get_hit_rate() * 100))
+        cache.clear()
+
+    def reset_class_hierarchy(self):
+        """
+            Forget the class hierarchy (a dex file has been added or a class renamed)
+        """
+        self.hierarchy = None
+
+    def get_class_hierarchy(self):
+        """
+            :rtype: the :class:`ClassHierarchy` object of all the dex files
+        """
+        if self.hierarchy is None:
+            self.hierarchy = ClassHierarchy(self.vms, self.framework_classes)
+        return self.hierarchy
+
     def construct_class_hierarchy(self):
+        hierarchy = self.get_class_hierarchy()
         for vm in self.vms:
             for current_class in vm.get_classes():
-                parent_class = vm.get_class(current_class.sname)
+                parent_class = hierarchy.get_class(current_class.sname)
                 if parent_class:
                     parent_class.set_childs_class_name(current_class.name)
                 else:
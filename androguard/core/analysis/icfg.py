@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compact inter-procedural control flow graph.
+#
+# The basic blocks of NewVmAnalysis keep their edges in lists of tuples
+# (from, to, block, kind), which costs a few hundred bytes per edge. This
+# module stores the same graph in compressed sparse row form: the blocks are
+# numbered, and the successors of block n are targets[offsets[n]:offsets[n + 1]],
+# with their kinds in kinds[offsets[n]:offsets[n + 1]]. The columns are
+# array.array objects of 32 bits integers (a few bytes per edge), which
+# numpy.frombuffer can wrap without a copy.
+#
+# The graph can be saved to a binary file, which is loaded back with one read
+# per section instead of parsing a dot file. The names are only split, and
+# indexed by name, when they are used. Layout (little endian):
+#
+#   header   : magic "ICFG", format version (u32), number of nodes (u32),
+#              number of edges (u32), size of the names (u32)
+#   offsets  : (number of nodes + 1) * i32
+#   targets  : number of edges * i32
+#   kinds    : number of edges * i8
+#   names    : the node names, separated by "\0"
+
+import os
+import sys
+import array
+import struct
+import cStringIO
+from xml.sax.saxutils import escape
+
+EDGE_INTRA = 0
+EDGE_INTER = 1
+EDGE_CALLBACK = 2
+
+EDGE_KINDS = {'intra': EDGE_INTRA, 'inter': EDGE_INTER, 'callback': EDGE_CALLBACK}
+EDGE_KIND_NAMES = dict((v, k) for k, v in EDGE_KINDS.items())
+
+ICFG_MAGIC = "ICFG"
+ICFG_VERSION = 1
+
+HEADER = struct.Struct("<4sIIII")
+
+
+def _to_le(a):
+    if sys.byteorder == "big":
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tostring()
+
+
+def _read_le(fd, typecode, nb):
+    a = array.array(typecode)
+    a.fromfile(fd, nb)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def _csr(nb_nodes, sources, targets, kinds):
+    """
+        Sort the edges by source (keeping the order of the edges of a node)
+        and return the (offsets, targets, kinds) columns
+    """
+    offsets = array.array('i', [0] * (nb_nodes + 1))
+    for src in sources:
+        offsets[src + 1] += 1
+    for n in xrange(nb_nodes):
+        offsets[n + 1] += offsets[n]
+
+    pos = array.array('i', offsets)
+    csr_targets = array.array('i', [0] * len(targets))
+    csr_kinds = array.array('b', [0] * len(kinds))
+    for src, dst, kind in zip(sources, targets, kinds):
+        p = pos[src]
+        csr_targets[p] = dst
+        csr_kinds[p] = kind
+        pos[src] = p + 1
+    return offsets, csr_targets, csr_kinds
+
+
+class CompactICFG(object):
+    """
+        The inter-procedural control flow graph of the blocks, in compressed
+        sparse row form
+
+        :param names: the names of the nodes (the index is the node id)
+        :param sources: the source node of each edge
+        :param targets: the target node of each edge
+        :param kinds: the kind of each edge (EDGE_INTRA, EDGE_INTER or EDGE_CALLBACK)
+    """
+
+    def __init__(self, names, sources, targets, kinds):
+        self.__names = names
+        # the names of a loaded graph, until they are used
+        self.__names_data = None
+        # name -> id, built on the first lookup by name
+        self.__ids = None
+
+        self.offsets, self.targets, self.kinds = _csr(len(names), sources, targets, kinds)
+
+        # the predecessors, built on the first query
+        self.__in_offsets = None
+        self.__in_sources = None
+        self.__in_kinds = None
+
+    @staticmethod
+    def from_analysis(vmx, release=False):
+        """
+            Build the graph of the blocks of a NewVmAnalysis, after
+            intro_procedural_cfg and the icfg passes (or analyze)
+
+            The edges are counted in a first walk over the blocks and copied
+            into their rows in a second one, without an intermediate list of
+            edges.
+
+            :param vmx: a :class:`NewVmAnalysis` object
+            :param release: drop the edges of each block (childs and fathers)
+                            once they are copied, the blocks of vmx can not
+                            be exported afterwards
+            :rtype: a :class:`CompactICFG` object
+        """
+        names = []
+        ids = {}
+        # the number of successors of each node
+        counts = array.array('i')
+
+        def get_id(name):
+            try:
+                return ids[name]
+            except KeyError:
+                # the names are shared by all the nodes and the exporters
+                name = intern(name)
+                ids[name] = len(names)
+                names.append(name)
+                counts.append(0)
+                return ids[name]
+
+        def get_blocks():
+            for vm in vmx.get_vms():
+                for method in vm.get_methods(vmx.framework_classes):
+                    g = vmx.methods.get(method)
+                    if g is None:
+                        continue
+                    for blocks in (g.basic_blocks, g.frame_blocks):
+                        for block in blocks.get():
+                            yield block
+
+        for block in get_blocks():
+            src = get_id(block.name)
+            for child in block.childs:
+                get_id(child[2].name)
+            counts[src] += len(block.childs)
+
+        offsets = array.array('i', [0] * (len(names) + 1))
+        for n in xrange(len(names)):
+            offsets[n + 1] = offsets[n] + counts[n]
+
+        pos = array.array('i', offsets)
+        targets = array.array('i', [0] * offsets[-1])
+        kinds = array.array('b', [0] * offsets[-1])
+        for block in get_blocks():
+            src = ids[block.name]
+            p = pos[src]
+            for child in block.childs:
+                targets[p] = ids[child[2].name]
+                kinds[p] = EDGE_KINDS[child[3]]
+                p += 1
+            pos[src] = p
+            if release:
+                block.childs = []
+                block.fathers = []
+
+        graph = CompactICFG([], [], [], [])
+        graph.__names = names
+        graph.__ids = ids
+        graph.offsets, graph.targets, graph.kinds = offsets, targets, kinds
+        return graph
+
+    def save(self, filename):
+        """
+            Save the graph to a binary file (see the layout at the top of this module)
+
+            :param filename: the path of the file
+        """
+        if self.__names is None:
+            names = self.__names_data
+        else:
+            names = "\0".join(self.__names)
+
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as fd:
+            fd.write(HEADER.pack(ICFG_MAGIC, ICFG_VERSION, self.get_nb_nodes(), self.get_nb_edges(), len(names)))
+            fd.write(_to_le(self.offsets))
+            fd.write(_to_le(self.targets))
+            fd.write(_to_le(self.kinds))
+            fd.write(names)
+        os.rename(tmp, filename)
+
+    @staticmethod
+    def load(filename):
+        """
+            Load a graph saved by :meth:`save`
+
+            :param filename: the path of the file
+            :rtype: a :class:`CompactICFG` object
+        """
+        with open(filename, "rb") as fd:
+            try:
+                magic, version, nb_nodes, nb_edges, names_size = HEADER.unpack(fd.read(HEADER.size))
+                if magic != ICFG_MAGIC or version != ICFG_VERSION:
+                    raise ValueError()
+                offsets = _read_le(fd, 'i', nb_nodes + 1)
+                targets = _read_le(fd, 'i', nb_edges)
+                kinds = _read_le(fd, 'b', nb_edges)
+                names = fd.read(names_size)
+                if len(names) != names_size:
+                    raise ValueError()
+            except (ValueError, EOFError, struct.error):
+                raise ValueError("%s is not a valid icfg file" % filename)
+
+        graph = CompactICFG([], [], [], [])
+        graph.__names = None
+        graph.__names_data = names
+        graph.offsets, graph.targets, graph.kinds = offsets, targets, kinds
+        return graph
+
+    @property
+    def names(self):
+        """
+            The names of the nodes (the index is the node id)
+        """
+        if self.__names is None:
+            self.__names = self.__names_data.split("\0") if self.get_nb_nodes() else []
+            self.__names_data = None
+        return self.__names
+
+    @property
+    def ids(self):
+        """
+            The ids of the nodes by name
+        """
+        if self.__ids is None:
+            self.__ids = dict((name, n) for n, name in enumerate(self.names))
+        return self.__ids
+
+    def get_nb_nodes(self):
+        return len(self.offsets) - 1
+
+    def get_nb_edges(self):
+        return len(self.targets)
+
+    def get_name(self, node):
+        return self.names[node]
+
+    def get_id(self, name):
+        """
+            :rtype: the id of a node, or None
+        """
+        return self.ids.get(name)
+
+    def nodes(self):
+        return xrange(self.get_nb_nodes())
+
+    def successors(self, node, kind=None):
+        """
+            Return the successors of a node
+
+            :param node: the id of the node
+            :param kind: only the edges of this kind (all the edges by default)
+            :rtype: an iterator of tuples (target id, kind)
+        """
+        for p in xrange(self.offsets[node], self.offsets[node + 1]):
+            if kind is None or self.kinds[p] == kind:
+                yield self.targets[p], self.kinds[p]
+
+    def predecessors(self, node, kind=None):
+        """
+            Return the predecessors of a node
+
+            :param node: the id of the node
+            :param kind: only the edges of this kind (all the edges by default)
+            :rtype: an iterator of tuples (source id, kind)
+        """
+        if self.__in_offsets is None:
+            sources = array.array('i')
+            for n in xrange(self.get_nb_nodes()):
+                sources.extend([n] * (self.offsets[n + 1] - self.offsets[n]))
+            self.__in_offsets, self.__in_sources, self.__in_kinds = \
+                _csr(self.get_nb_nodes(), self.targets, sources, self.kinds)
+
+        for p in xrange(self.__in_offsets[node], self.__in_offsets[node + 1]):
+            if kind is None or self.__in_kinds[p] == kind:
+                yield self.__in_sources[p], self.__in_kinds[p]
+
+    def edges(self, kind=None):
+        """
+            Return the edges
+
+            :param kind: only the edges of this kind (all the edges by default)
+            :rtype: an iterator of tuples (source id, target id, kind)
+        """
+        for n in xrange(self.get_nb_nodes()):
+            for p in xrange(self.offsets[n], self.offsets[n + 1]):
+                if kind is None or self.kinds[p] == kind:
+                    yield n, self.targets[p], self.kinds[p]
+
+    def write_dot(self, f, kind=EDGE_INTER):
+        """
+            Write the graph in the dot format of NewVmAnalysis.export_to_dot
+            to a file object
+
+            :param f: a file object
+            :param kind: only the edges of this kind (EDGE_INTER by default, None: all the edges)
+        """
+        # each name is quoted once
+        dots = ['"%s"' % name for name in self.names]
+
+        f.write("digraph CFG {\n")
+        for src, dst, _ in self.edges(kind):
+            f.write(dots[src] + ' -> ' + dots[dst] + '\n')
+        for dot in dots:
+            f.write(dot + '\n')
+        f.write("\n}")
+
+    def export_to_dot(self, kind=EDGE_INTER):
+        """
+            Return the graph in the dot format of NewVmAnalysis.export_to_dot
+
+            :param kind: only the edges of this kind (EDGE_INTER by default, None: all the edges)
+        """
+        buff = cStringIO.StringIO()
+        self.write_dot(buff, kind)
+        return buff.getvalue()
+
+    def write_gexf(self, f, kind=None):
+        """
+            Write the graph in the gexf format, with the kind of each edge,
+            to a file object
+
+            :param f: a file object
+            :param kind: only the edges of this kind (all the edges by default)
+        """
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gexf xmlns="http://www.gephi.org/gexf" xmlns:viz="http://www.gephi.org/gexf/viz">\n'
+                '<graph type="static" defaultedgetype="directed">\n'
+                '<attributes class="edge" type="static">\n'
+                '<attribute id="0" title="kind" type="string"/>\n'
+                '</attributes>\n'
+                '<nodes>\n')
+        for n, name in enumerate(self.names):
+            f.write('<node id="%d" label="%s"/>\n' % (n, escape(name, {'"': '&quot;'})))
+        f.write('</nodes>\n')
+
+        f.write('<edges>\n')
+        for nb, (src, dst, k) in enumerate(self.edges(kind)):
+            f.write('<edge id="%d" source="%d" target="%d">\n'
+                    '<attvalues><attvalue for="0" value="%s"/></attvalues>\n'
+                    '</edge>\n' % (nb, src, dst, EDGE_KIND_NAMES[k]))
+        f.write('</edges>\n')
+
+        f.write('</graph>\n')
+        f.write('</gexf>\n')
+
+    def export_to_gexf(self, kind=None):
+        """
+            Return the graph in the gexf format, with the kind of each edge
+
+            :param kind: only the edges of this kind (all the edges by default)
+        """
+        buff = cStringIO.StringIO()
+        self.write_gexf(buff, kind)
+        return buff.getvalue()
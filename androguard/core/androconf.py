@@ -20,12 +20,12 @@
 
 import sys
 import os
+import re
 import logging
 import types
 import random
 import string
-from androguard.core.api_specific_resources.aosp_permissions.aosp_permissions import AOSP_PERMISSIONS
-from androguard.core.api_specific_resources.api_permission_mappings.api_permission_mappings import AOSP_PERMISSIONS_MAPPINGS
+from androguard.core.api_specific_resources.permission_index import load_table
 
 ANDROGUARD_VERSION = '3.0-dev'
 
@@ -58,6 +58,13 @@ CONF = {  # Full python or mix python/c++ (native)
     'RECODE_ASCII_STRING': False,
     'RECODE_ASCII_STRING_METH': None,
     'LAZY_ANALYSIS': False,
+    # maximum number of decoded instructions kept for all the dex files of
+    # an analysis (None: no limit, 0: decode the methods at each pass).
+    # A decoded instruction costs about 100 to 200 bytes, so 1000000 keeps
+    # up to a few hundred MB alive.
+    'INSTRUCTIONS_CACHE_SIZE': 0,
+    # number of processes which build the basic blocks of the methods
+    'CFG_PROCESSES': 1,
     'ENGINE': 'python',
     'OPTIONS_FERNFLOWER': {'dgs': '1', 'asc': '1'},
     'PRETTY_SHOW': 1,
@@ -89,6 +96,11 @@ CONF = {  # Full python or mix python/c++ (native)
         },
     'PRINT_FCT': sys.stdout.write,
     'MAGIC_PATH_FILE': None,
+    'DEFAULT_API': '9',
+    'PERMISSION_INDEX_DIRECTORY': None,
+    # package prefixes of bundled libraries (okhttp, firebase ...) which are
+    # skipped like the framework classes
+    'LIBRARY_CLASSES': [],
     }
 
 
@@ -369,20 +381,52 @@ def color_range(startcolor, goalcolor, steps):
     return interpolate_tuple(start_tuple, goal_tuple, steps)
 
 
+API_SPECIFIC_RESOURCES = {
+    "aosp_permissions": (
+        "androguard.core.api_specific_resources.aosp_permissions.aosp_permissions_api%s",
+        {"AOSP_PERMISSIONS": "AOSP_PERMISSIONS",
+         "AOSP_PERMISSIONS_GROUPS": "AOSP_PERMISSION_GROUPS"}),
+    "api_permission_mappings": (
+        "androguard.core.api_specific_resources.api_permission_mappings.api_permission_mappings_api%s",
+        {"AOSP_PERMISSIONS_BY_METHODS": "AOSP_PERMISSIONS_BY_METHODS",
+         "AOSP_PERMISSIONS_BY_FIELDS": "AOSP_PERMISSIONS_BY_FIELDS"}),
+}
+
+API_SPECIFIC_LEVELS = ['9', '10', '14', '15', '16', '17', '18', '19', '21', '22']
+
+# (resource_name, api) -> loaded resource, filled on first use
+_api_specific_resources_cache = {}
+
+
 def load_api_specific_resource_module(resource_name, api):
-    if resource_name == "aosp_permissions":
-        module = AOSP_PERMISSIONS
-    elif resource_name == "api_permission_mappings":
-        module = AOSP_PERMISSIONS_MAPPINGS
-    else:
+    """
+    Return the resource of the given api level, loading only the tables of
+    this level the first time it is requested (the other levels are never
+    loaded). The tables are read from their memory-mapped index files when
+    they have been built (see permission_index), else from their modules.
+    Unknown api levels fall back to the api 9 resource.
+
+    :param resource_name: "aosp_permissions" or "api_permission_mappings"
+    :param api: the api level (string or int), CONF["DEFAULT_API"] if None
+    :rtype: dict
+    """
+    if resource_name not in API_SPECIFIC_RESOURCES:
         error("Invalid resource: %s" % resource_name)
 
     if not api:
         api = CONF["DEFAULT_API"]
-    value = module.get(api)
-    if value:
-        return value
-    return module.get('9')
+    api = str(api)
+    if api not in API_SPECIFIC_LEVELS:
+        api = '9'
+
+    key = (resource_name, api)
+    if key not in _api_specific_resources_cache:
+        module_name, attributes = API_SPECIFIC_RESOURCES[resource_name]
+        _api_specific_resources_cache[key] = dict(
+            (name, load_table(module_name % api, attr, CONF["PERMISSION_INDEX_DIRECTORY"]))
+            for name, attr in attributes.items())
+    return _api_specific_resources_cache[key]
+
 
 framework_classes = ["Landroid/accessibilityservice",
                      "Landroid/accounts",
@@ -439,4 +483,50 @@ framework_classes = ["Landroid/accessibilityservice",
                      "Lorg/xml/sax",
                      "Lorg/xmlpull/v1",
                      "Landroid/support"
-                     ]
\ No newline at end of file
+                     ]
+
+
+class FrameworkClasses(object):
+    """
+    Tell if a class belongs to the framework from its package prefix, with one
+    anchored regular expression over all the prefixes and a memo of the class
+    names already classified
+
+    :param prefixes: the package prefixes of the framework classes
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = list(prefixes)
+        if self.prefixes:
+            self.__match = re.compile("|".join(re.escape(i) for i in self.prefixes)).match
+        else:
+            self.__match = lambda class_name: None
+        self.__memo = {}
+
+    def is_framework_class(self, class_name):
+        try:
+            return self.__memo[class_name]
+        except KeyError:
+            ret = self.__memo[class_name] = self.__match(class_name) is not None
+            return ret
+
+    __call__ = is_framework_class
+
+    def __iter__(self):
+        return iter(self.prefixes)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+
+def get_framework_classes(prefixes=None):
+    """
+    Return the classifier of the framework classes
+
+    :param prefixes: the package prefixes of the framework classes
+                     (framework_classes and CONF["LIBRARY_CLASSES"] by default)
+    :rtype: a :class:`FrameworkClasses` object
+    """
+    if prefixes is None:
+        prefixes = framework_classes + list(CONF["LIBRARY_CLASSES"])
+    return FrameworkClasses(prefixes)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compact on-disk index of the api -> permission tables.
+#
+# The api_permission_mappings_apiNN.py modules are multi-megabytes python
+# dict literals: every process which imports them
+# executes the literals and builds its own dicts. This module compiles
+# such a table into a sorted string table which is memory-mapped at
+# runtime, so a lookup is a binary search over the mapped file and all the
+# processes share the same page-cache copy.
+#
+# Layout (little endian):
+#
+#   header   : magic "APIX", format version (u32), number of entries (u32)
+#   entries  : number of entries * (key offset, key length,
+#                                   value offset, value length) (4 * u32),
+#              sorted by key
+#   data     : keys (utf-8) and values (marshal format)
+#
+# Build the index files of all the tables with:
+#
+#   python -m androguard.core.api_specific_resources.permission_index [output_directory]
+
+import os
+import sys
+import mmap
+import struct
+import collections
+import marshal
+import importlib
+
+INDEX_MAGIC = "APIX"
+INDEX_VERSION = 1
+
+HEADER = struct.Struct("<4sII")
+ENTRY = struct.Struct("<IIII")
+
+INDEX_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index")
+
+# module name -> tables of this module which are compiled
+INDEX_TABLES = {}
+
+for api in ['9', '10', '14', '15', '16', '17', '18', '19', '21', '22']:
+    INDEX_TABLES["androguard.core.api_specific_resources.api_permission_mappings.api_permission_mappings_api%s" % api] = \
+        ["AOSP_PERMISSIONS_BY_METHODS", "AOSP_PERMISSIONS_BY_FIELDS"]
+
+
+def get_index_path(module_name, table, directory=None):
+    """
+    Return the path of the index file of a table
+
+    :param module_name: the name of the module which defines the table
+    :param table: the name of the table in the module
+    :param directory: the directory of the index files (INDEX_DIRECTORY by default)
+    :rtype: string
+    """
+    return os.path.join(directory or INDEX_DIRECTORY,
+                        "%s.%s.idx" % (module_name.split('.')[-1], table))
+
+
+def _to_key(key):
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+    return key
+
+
+def build_index(table, path):
+    """
+    Compile a dict into an index file
+
+    :param table: the dict to compile (string keys, marshallable values)
+    :param path: the path of the index file
+    """
+    items = sorted((_to_key(k), marshal.dumps(v)) for k, v in table.items())
+
+    data_off = HEADER.size + ENTRY.size * len(items)
+    entries = []
+    data = []
+    off = data_off
+    for key, value in items:
+        entries.append(ENTRY.pack(off, len(key), off + len(key), len(value)))
+        data.append(key)
+        data.append(value)
+        off += len(key) + len(value)
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fd:
+        fd.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(items)))
+        fd.write("".join(entries))
+        fd.write("".join(data))
+    os.rename(tmp, path)
+
+
+class PermissionIndex(collections.Mapping):
+    """
+    A read-only dict over an index file built by :func:`build_index`: the
+    lookups and the iterations of a dict (keys, values, items and their
+    iter versions) are served from the mapped file
+
+    :param path: the path of the index file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fd:
+            self.__map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.__size = HEADER.unpack_from(self.__map, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("%s is not a valid permission index" % path)
+
+    def __entry(self, idx):
+        return ENTRY.unpack_from(self.__map, HEADER.size + idx * ENTRY.size)
+
+    def __key(self, idx):
+        key_off, key_len, _, _ = self.__entry(idx)
+        return self.__map[key_off:key_off + key_len]
+
+    def __value(self, idx):
+        _, _, value_off, value_len = self.__entry(idx)
+        return marshal.loads(self.__map[value_off:value_off + value_len])
+
+    def __find(self, key):
+        key = _to_key(key)
+        lo, hi = 0, self.__size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.__size and self.__key(lo) == key:
+            return lo
+        return -1
+
+    def get(self, key, default=None):
+        idx = self.__find(key)
+        if idx == -1:
+            return default
+        return self.__value(idx)
+
+    def __getitem__(self, key):
+        idx = self.__find(key)
+        if idx == -1:
+            raise KeyError(key)
+        return self.__value(idx)
+
+    def __contains__(self, key):
+        return self.__find(key) != -1
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self.__size
+
+    def __iter__(self):
+        for idx in xrange(self.__size):
+            yield self.__key(idx)
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for idx in xrange(self.__size):
+            yield self.__value(idx)
+
+    def iteritems(self):
+        for idx in xrange(self.__size):
+            yield self.__key(idx), self.__value(idx)
+
+    def copy(self):
+        """
+        :rtype: a dict of the whole table
+        """
+        return dict(self.iteritems())
+
+    def close(self):
+        self.__map.close()
+
+
+def load_table(module_name, table, directory=None):
+    """
+    Return a table, from its index file if it has been built, or else from
+    its python module
+
+    :param module_name: the name of the module which defines the table
+    :param table: the name of the table in the module
+    :param directory: the directory of the index files (INDEX_DIRECTORY by default)
+    :rtype: a :class:`PermissionIndex` or a dict
+    """
+    path = get_index_path(module_name, table, directory)
+    if os.path.isfile(path):
+        try:
+            return PermissionIndex(path)
+        except ValueError:
+            pass
+    return getattr(importlib.import_module(module_name), table)
+
+
+def build_all(directory=None):
+    """
+    Build the index files of all the tables of INDEX_TABLES
+
+    :param directory: the output directory (INDEX_DIRECTORY by default)
+    """
+    directory = directory or INDEX_DIRECTORY
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for module_name in sorted(INDEX_TABLES):
+        module = importlib.import_module(module_name)
+        for table in INDEX_TABLES[module_name]:
+            path = get_index_path(module_name, table, directory)
+            build_index(getattr(module, table), path)
+            print "%s (%d bytes)" % (path, os.path.getsize(path))
+
+
+if __name__ == "__main__":
+    build_all(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -19,6 +19,7 @@
 # limitations under the License.
 
 import hashlib
+import mmap
 from xml.sax.saxutils import escape
 from struct import unpack, pack
 import textwrap
@@ -832,6 +833,26 @@ class _Bytecode(object):
     def read_b(self, size):
         return self.__buff[self.__idx:self.__idx + size]
 
+    def find(self, sub, start=0):
+        """
+            Return the lowest offset (from start) where sub is found in the
+            buffer, or -1
+
+            :rtype: int
+        """
+        if isinstance(self.__buff, str):
+            return self.__buff.find(sub, start)
+
+        # a mapped buffer has no find(): search block by block
+        size = len(self.__buff)
+        while start < size:
+            block = self.__buff[start:start + 4096 + len(sub) - 1]
+            idx = block.find(sub)
+            if idx != -1:
+                return start + idx
+            start += 4096
+        return -1
+
     def set_idx(self, idx):
         self.__idx = idx
 
@@ -859,6 +880,27 @@ class _Bytecode(object):
             fd.write(buff)
 
 
+def read_mmap(filename, offset=0, size=None):
+    """
+       Map (a part of) a file in memory without copying it. The result can be
+       given to :class:`_Bytecode` (or DalvikVMFormat) in place of a string:
+       a read only copies the requested bytes, and the pages of the file are
+       shared with the other processes which map it.
+
+       :param filename: the path of the file
+       :param offset: the offset of the first byte in the file
+       :param size: the number of bytes (until the end of the file by default)
+       :rtype: a read-only buffer
+    """
+
+    with open(filename, 'rb') as fd:
+        m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if size is None:
+        size = len(m) - offset
+    return buffer(m, offset, size)
+
+
 def FormatClassToJava(inputclass):
     """
        Transoform a typical xml format class into java format
@@ -870,7 +912,7 @@ def FormatClassToJava(inputclass):
     return 'L' + inputclass.replace('.', '/') + ';'
 
 
-def FormatClassToPython():
+def FormatClassToPython(input):
     i = input[:-1]
     i = i.replace('/', '_')
     i = i.replace('$', '_')
@@ -51,11 +51,16 @@ class APK(object):
         This class can access to all elements in an APK file
         :param filename: specify the path of the file
         :type filename: string
+        :param mapped: map the file in memory instead of reading it, the
+                       stored (uncompressed) dex files are then returned
+                       without copy (see :meth:`get_file_buffer`)
+        :type mapped: boolean
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, mapped=False):
 
         self.filename = filename
+        self.mapped = mapped
 
         self.xml = {}
         self.axml = {}
@@ -69,11 +74,14 @@ class APK(object):
         # find onClick function and Button id in layout xml files
         self.xmlcallbacks = []
 
-        self.__raw = read(filename)
-
         import zipfile
         try:
-            self.zip = zipfile.ZipFile(StringIO.StringIO(self.__raw))
+            if mapped:
+                self.__raw = bytecode.read_mmap(filename)
+                self.zip = zipfile.ZipFile(filename)
+            else:
+                self.__raw = read(filename)
+                self.zip = zipfile.ZipFile(StringIO.StringIO(self.__raw))
         except IOError:
             return
 
@@ -177,7 +185,7 @@ class APK(object):
         :return: dex file
         """
         try:
-            return self.get_file("classes.dex")
+            return self.get_file_buffer("classes.dex")
         except FileNotPresent:
             return ""
 
@@ -189,12 +197,12 @@ class APK(object):
         """
         try:
 
-            yield self.get_file("classes.dex")
+            yield self.get_file_buffer("classes.dex")
 
             # Multidex support
             basename = "classes%d.dex"
             for i in xrange(2, sys.maxint):
-                yield self.get_file(basename % i)
+                yield self.get_file_buffer(basename % i)
         except FileNotPresent:
             pass
 
@@ -216,6 +224,30 @@ class APK(object):
         except KeyError:
             raise FileNotPresent(filename)
 
+    def get_file_buffer(self, filename):
+        """
+            Return the raw data of the specified filename, without copy if
+            the APK is mapped and the file is stored uncompressed (the dex
+            files: the parsers of the manifest and of the resources need
+            a string, see :meth:`get_file`)
+            :param filename a string which specify the filename
+            :rtype: string, or a read-only buffer over the mapped APK
+        """
+        try:
+            info = self.zip.getinfo(filename)
+        except KeyError:
+            raise FileNotPresent(filename)
+
+        if self.mapped and info.compress_type == 0:
+            # local file header: the name and the extra field lengths are
+            # at 26 and 28, the data follows the 30 bytes header
+            offset = info.header_offset
+            name_length, extra_length = unpack('<HH', self.__raw[offset + 26:offset + 30])
+            offset += 30 + name_length + extra_length
+            return buffer(self.__raw, offset, info.file_size)
+
+        return self.zip.read(filename)
+
     def get_elements(self, tag_name, attribute):
         """
             Return elements in xml files which match with the tag name and the specific attribute
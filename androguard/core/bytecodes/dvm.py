@@ -19,12 +19,15 @@
 
 from androguard.core import bytecode
 from androguard.core.androconf import CONF, debug, warning, \
-    is_android_raw
+    is_android_raw, FrameworkClasses, get_framework_classes
 from androguard.util import read
 
 import sys
 import re
 import struct
+import collections
+import bisect
+import array
 from struct import pack, unpack, calcsize
 
 DEX_FILE_MAGIC_35 = 'dex\n035\x00'
@@ -1465,7 +1468,7 @@ class DebugInfoItemEmpty(object):
 
         self.offset = buff.get_idx()
         self.__buff = buff
-        self.__raw = ''
+        self.__raw = None
 
     def set_off(self, off):
         self.offset = off
@@ -1474,14 +1477,8 @@ class DebugInfoItemEmpty(object):
         return self.offset
 
     def reload(self):
-        offset = self.offset
-
-        n = self.__CM.get_next_offset_item(offset)
-
-        s_idx = self.__buff.get_idx()
-        self.__buff.set_idx(offset)
-        self.__raw = self.__buff.read(n - offset)
-        self.__buff.set_idx(s_idx)
+        # the raw debug infos are only read if they are asked (get_raw)
+        self.__raw = None
 
     def show(self):
         pass
@@ -1490,10 +1487,19 @@ class DebugInfoItemEmpty(object):
         return []
 
     def get_raw(self):
+        if self.__raw is None:
+            offset = self.offset
+
+            n = self.__CM.get_next_offset_item(offset)
+
+            s_idx = self.__buff.get_idx()
+            self.__buff.set_idx(offset)
+            self.__raw = self.__buff.read(n - offset)
+            self.__buff.set_idx(s_idx)
         return self.__raw
 
     def get_length(self):
-        return len(self.__raw)
+        return len(self.get_raw())
 
 
 class EncodedArray(object):
@@ -1953,10 +1959,17 @@ def utf8_to_string(buff, length):
     return ''.join(chars).encode('utf-8')
 
 
+# a MUTF-8 string made only of ascii characters (and without any zero byte)
+# is its own decoding
+ASCII_STRING = re.compile('[\x01-\x7f]*\Z')
+
+
 class StringDataItem(object):
 
     """
-        This class can parse a string_data_item of a dex file
+        This class can parse a string_data_item of a dex file. The ascii
+        strings are read directly, the other strings are only decoded
+        the first time they are asked (see get)
 
         :param buff: a string which represents a Buff object of the string_data_item
         :type buff: Buff object
@@ -1966,12 +1979,26 @@ class StringDataItem(object):
 
     def __init__(self, buff, cm):
         self.__CM = cm
+        self.__buff = buff
 
         self.offset = buff.get_idx()
 
         self.utf16_size = readuleb128(buff)
 
-        self.data = utf8_to_string(buff, self.utf16_size)
+        self.data = None
+        self.__data_off = buff.get_idx()
+
+        raw = buff.read_b(self.utf16_size + 1)
+        if raw[-1:] == '\00' and ASCII_STRING.match(raw, 0, self.utf16_size):
+            self.data = raw[:-1]
+            buff.set_idx(self.__data_off + self.utf16_size)
+        else:
+            # a zero byte can't be in a MUTF-8 string, it is the end of the data
+            end = buff.find('\00', self.__data_off)
+            if end == -1:
+                self.data = utf8_to_string(buff, self.utf16_size)
+            else:
+                buff.set_idx(end)
 
         expected = buff.read(1)
 
@@ -1995,7 +2022,7 @@ class StringDataItem(object):
           :rtype: string
       """
 
-        return self.data
+        return self.get()
 
     def set_off(self, off):
         self.offset = off
@@ -2007,21 +2034,26 @@ class StringDataItem(object):
         pass
 
     def get(self):
+        if self.data is None:
+            idx = self.__buff.get_idx()
+            self.__buff.set_idx(self.__data_off)
+            self.data = utf8_to_string(self.__buff, self.utf16_size)
+            self.__buff.set_idx(idx)
         return self.data
 
     def show(self):
         bytecode._PrintSubBanner('String Data Item')
         bytecode._PrintDefault('utf16_size=%d data=%s\n'
-                               % (self.utf16_size, repr(self.data)))
+                               % (self.utf16_size, repr(self.get())))
     @staticmethod
     def get_obj():
         return []
 
     def get_raw(self):
-        return writeuleb128(self.utf16_size) + self.data
+        return writeuleb128(self.utf16_size) + self.get()
 
     def get_length(self):
-        return len(writeuleb128(self.utf16_size)) + len(self.data)
+        return len(writeuleb128(self.utf16_size)) + len(self.get())
 
 
 class StringIdItem(object):
@@ -4166,7 +4198,16 @@ class Instruction(object):
 
     """
         This class represents a dalvik instruction
+
+        The instructions are decoded by millions, so each class declares the
+        attributes of its format in __slots__: no instance has a __dict__.
+        An instruction takes 56 to 120 bytes (python 2.7, 64 bits, without
+        its operand values) instead of 344 to 1112 bytes with a __dict__,
+        e.g. 120 bytes instead of 1112 for an invoke-* Instruction35c.
     """
+
+    __slots__ = ()
+
     def get_kind(self):
         """
             Return the 'kind' argument of the instruction
@@ -4281,6 +4322,8 @@ class InstructionInvalid(Instruction):
         This class represents an invalid instruction
     """
 
+    __slots__ = ('OP',)
+
     def __init__(self, cm, buff):
         super(InstructionInvalid, self).__init__()
 
@@ -4319,6 +4362,8 @@ class FillArrayData(object):
         :param buff: a Buff object which represents a buffer where the instruction is stored
     """
 
+    __slots__ = ('notes', 'format_general_size', 'ident', 'element_width', 'size', 'data')
+
     def __init__(self, buff):
         self.notes = []
 
@@ -4443,6 +4488,8 @@ class SparseSwitch(object):
         :param buff: a Buff object which represents a buffer where the instruction is stored
     """
 
+    __slots__ = ('notes', 'format_general_size', 'ident', 'size', 'keys', 'targets')
+
     def __init__(self, buff):
         self.notes = []
 
@@ -4577,6 +4624,8 @@ class PackedSwitch(object):
         :param buff: a Buff object which represents a buffer where the instruction is stored
     """
 
+    __slots__ = ('notes', 'format_general_size', 'ident', 'size', 'first_key', 'targets')
+
     def __init__(self, buff):
         self.notes = []
 
@@ -4714,6 +4763,8 @@ class Instruction35c(Instruction):
         This class represents all instructions which have the 35c format
     """
 
+    __slots__ = ('cm', 'OP', 'G', 'A', 'BBBB', 'C', 'D', 'E', 'F')
+
     def __init__(self, cm, buff):
         super(Instruction35c, self).__init__()
         self.cm = cm
@@ -4809,6 +4860,8 @@ class Instruction10x(Instruction):
         This class represents all instructions which have the 10x format
     """
 
+    __slots__ = ('OP',)
+
     def __init__(self, cm, buff):
         super(Instruction10x, self).__init__()
 
@@ -4836,6 +4889,8 @@ class Instruction21h(Instruction):
         This class represents all instructions which have the 21h format
     """
 
+    __slots__ = ('OP', 'AA', 'BBBB', 'formatted_operands')
+
     def __init__(self, cm, buff):
         super(Instruction21h, self).__init__()
 
@@ -4889,6 +4944,8 @@ class Instruction11n(Instruction):
         This class represents all instructions which have the 11n format
     """
 
+    __slots__ = ('OP', 'A', 'B')
+
     def __init__(self, cm, buff):
         super(Instruction11n, self).__init__()
 
@@ -4923,6 +4980,8 @@ class Instruction21c(Instruction):
         This class represents all instructions which have the 21c format
     """
 
+    __slots__ = ('cm', 'OP', 'AA', 'BBBB')
+
     def __init__(self, cm, buff):
         super(Instruction21c, self).__init__()
         self.cm = cm
@@ -4968,6 +5027,8 @@ class Instruction21s(Instruction):
         This class represents all instructions which have the 21s format
     """
 
+    __slots__ = ('OP', 'AA', 'BBBB', 'formatted_operands')
+
     def __init__(self, cm, buff):
         super(Instruction21s, self).__init__()
 
@@ -5017,6 +5078,8 @@ class Instruction22c(Instruction):
         This class represents all instructions which have the 22c format
     """
 
+    __slots__ = ('cm', 'OP', 'A', 'B', 'CCCC')
+
     def __init__(self, cm, buff):
         super(Instruction22c, self).__init__()
         self.cm = cm
@@ -5057,6 +5120,8 @@ class Instruction22cs(Instruction):
         This class represents all instructions which have the 22cs format
     """
 
+    __slots__ = ('cm', 'OP', 'A', 'B', 'CCCC')
+
     def __init__(self, cm, buff):
         super(Instruction22cs, self).__init__()
         self.cm = cm
@@ -5097,6 +5162,8 @@ class Instruction31t(Instruction):
         This class represents all instructions which have the 31t format
     """
 
+    __slots__ = ('OP', 'AA', 'BBBBBBBB')
+
     def __init__(self, cm, buff):
         super(Instruction31t, self).__init__()
         i16 = unpack('=H', buff[0:2])[0]
@@ -5134,6 +5201,8 @@ class Instruction31c(Instruction):
         This class represents all instructions which have the 31c format
     """
 
+    __slots__ = ('cm', 'OP', 'AA', 'BBBBBBBB')
+
     def __init__(self, cm, buff):
         super(Instruction31c, self).__init__()
         self.cm = cm
@@ -5186,6 +5255,8 @@ class Instruction12x(Instruction):
         This class represents all instructions which have the 12x format
     """
 
+    __slots__ = ('OP', 'A', 'B')
+
     def __init__(self, cm, buff):
         super(Instruction12x, self).__init__()
 
@@ -5217,6 +5288,8 @@ class Instruction11x(Instruction):
         This class represents all instructions which have the 11x format
     """
 
+    __slots__ = ('OP', 'AA')
+
     def __init__(self, cm, buff):
         super(Instruction11x, self).__init__()
 
@@ -5247,6 +5320,8 @@ class Instruction51l(Instruction):
         This class represents all instructions which have the 51l format
     """
 
+    __slots__ = ('OP', 'AA', 'BBBBBBBBBBBBBBBB', 'formatted_operands')
+
     def __init__(self, cm, buff):
         super(Instruction51l, self).__init__()
 
@@ -5298,6 +5373,8 @@ class Instruction31i(Instruction):
         This class represents all instructions which have the 3li format
     """
 
+    __slots__ = ('OP', 'AA', 'BBBBBBBB', 'formatted_operands')
+
     def __init__(self, cm, buff):
         super(Instruction31i, self).__init__()
 
@@ -5351,6 +5428,8 @@ class Instruction22x(Instruction):
         This class represents all instructions which have the 22x format
     """
 
+    __slots__ = ('OP', 'AA', 'BBBB')
+
     def __init__(self, cm, buff):
         super(Instruction22x, self).__init__()
 
@@ -5384,6 +5463,8 @@ class Instruction23x(Instruction):
         This class represents all instructions which have the 23x format
     """
 
+    __slots__ = ('OP', 'AA', 'BB', 'CC')
+
     def __init__(self, cm, buff):
         super(Instruction23x, self).__init__()
 
@@ -5420,6 +5501,8 @@ class Instruction20t(Instruction):
         This class represents all instructions which have the 20t format
     """
 
+    __slots__ = ('OP', 'AAAA')
+
     def __init__(self, cm, buff):
         super(Instruction20t, self).__init__()
 
@@ -5453,6 +5536,8 @@ class Instruction21t(Instruction):
         This class represents all instructions which have the 21t format
     """
 
+    __slots__ = ('OP', 'AA', 'BBBB')
+
     def __init__(self, cm, buff):
         super(Instruction21t, self).__init__()
 
@@ -5489,6 +5574,8 @@ class Instruction10t(Instruction):
         This class represents all instructions which have the 10t format
     """
 
+    __slots__ = ('OP', 'AA')
+
     def __init__(self, cm, buff):
         super(Instruction10t, self).__init__()
 
@@ -5521,6 +5608,8 @@ class Instruction22t(Instruction):
         This class represents all instructions which have the 22t format
     """
 
+    __slots__ = ('OP', 'A', 'B', 'CCCC')
+
     def __init__(self, cm, buff):
         super(Instruction22t, self).__init__()
 
@@ -5558,6 +5647,8 @@ class Instruction22s(Instruction):
         This class represents all instructions which have the 22s format
     """
 
+    __slots__ = ('OP', 'A', 'B', 'CCCC')
+
     def __init__(self, cm, buff):
         super(Instruction22s, self).__init__()
 
@@ -5595,6 +5686,8 @@ class Instruction22b(Instruction):
         This class represents all instructions which have the 22b format
     """
 
+    __slots__ = ('OP', 'AA', 'BB', 'CC')
+
     def __init__(self, cm, buff):
         super(Instruction22b, self).__init__()
 
@@ -5633,6 +5726,8 @@ class Instruction30t(Instruction):
         This class represents all instructions which have the 30t format
     """
 
+    __slots__ = ('OP', 'AAAAAAAA')
+
     def __init__(self, cm, buff):
         super(Instruction30t, self).__init__()
 
@@ -5667,6 +5762,8 @@ class Instruction3rc(Instruction):
         This class represents all instructions which have the 3rc format
     """
 
+    __slots__ = ('cm', 'OP', 'AA', 'BBBB', 'CCCC', 'NNNN')
+
     def __init__(self, cm, buff):
         super(Instruction3rc, self).__init__()
         self.cm = cm
@@ -5724,6 +5821,8 @@ class Instruction32x(Instruction):
         This class represents all instructions which have the 32x format
     """
 
+    __slots__ = ('OP', 'AAAA', 'BBBB')
+
     def __init__(self, cm, buff):
         super(Instruction32x, self).__init__()
 
@@ -5756,6 +5855,8 @@ class Instruction20bc(Instruction):
         This class represents all instructions which have the 20bc format
     """
 
+    __slots__ = ('OP', 'AA', 'BBBB')
+
     def __init__(self, cm, buff):
         super(Instruction20bc, self).__init__()
 
@@ -5789,6 +5890,8 @@ class Instruction35mi(Instruction):
         This class represents all instructions which have the 35mi format
     """
 
+    __slots__ = ('cm', 'OP', 'G', 'A', 'BBBB', 'C', 'D', 'E', 'F')
+
     def __init__(self, cm, buff):
         super(Instruction35mi, self).__init__()
         self.cm = cm
@@ -5883,6 +5986,8 @@ class Instruction35ms(Instruction):
         This class represents all instructions which have the 35ms format
     """
 
+    __slots__ = ('cm', 'OP', 'G', 'A', 'BBBB', 'C', 'D', 'E', 'F')
+
     def __init__(self, cm, buff):
         super(Instruction35ms, self).__init__()
         self.cm = cm
@@ -5977,6 +6082,8 @@ class Instruction3rmi(Instruction):
         This class represents all instructions which have the 3rmi format
     """
 
+    __slots__ = ('cm', 'OP', 'AA', 'BBBB', 'CCCC', 'NNNN')
+
     def __init__(self, cm, buff):
         super(Instruction3rmi, self).__init__()
         self.cm = cm
@@ -6034,6 +6141,8 @@ class Instruction3rms(Instruction):
         This class represents all instructions which have the 3rms format
     """
 
+    __slots__ = ('cm', 'OP', 'AA', 'BBBB', 'CCCC', 'NNNN')
+
     def __init__(self, cm, buff):
         super(Instruction3rms, self).__init__()
         self.cm = cm
@@ -6091,6 +6200,8 @@ class Instruction41c(Instruction):
         This class represents all instructions which have the 41c format
     """
 
+    __slots__ = ('cm', 'OP', 'BBBBBBBB', 'AAAA')
+
     def __init__(self, cm, buff):
         super(Instruction41c, self).__init__()
         self.cm = cm
@@ -6130,6 +6241,8 @@ class Instruction40sc(Instruction):
         This class represents all instructions which have the 40sc format
     """
 
+    __slots__ = ('cm', 'OP', 'BBBBBBBB', 'AAAA')
+
     def __init__(self, cm, buff):
         super(Instruction40sc, self).__init__()
         self.cm = cm
@@ -6168,6 +6281,8 @@ class Instruction52c(Instruction):
         This class represents all instructions which have the 52c format
     """
 
+    __slots__ = ('cm', 'OP', 'CCCCCCCC', 'AAAA', 'BBBB')
+
     def __init__(self, cm, buff):
         super(Instruction52c, self).__init__()
         self.cm = cm
@@ -6209,6 +6324,8 @@ class Instruction5rc(Instruction):
         This class represents all instructions which have the 5rc format
     """
 
+    __slots__ = ('cm', 'OP', 'BBBBBBBB', 'AAAA', 'CCCC', 'NNNN')
+
     def __init__(self, cm, buff):
         super(Instruction5rc, self).__init__()
         self.cm = cm
@@ -6624,6 +6741,8 @@ DALVIK_OPCODES_OPTIMIZED = {
 
 class Unresolved(Instruction):
 
+    __slots__ = ('cm', 'data')
+
     def __init__(self, cm, data):
         self.cm = cm
         self.data = data
@@ -6657,7 +6776,7 @@ def get_instruction(cm, op_value, buff, odex=False):
         except KeyError:
             return InstructionInvalid(cm, buff)
     except:
-        return Unresolved(cm, buff)
+        return Unresolved(cm, buff[:])
 
 
 def get_extented_instruction(cm, op_value, buff):
@@ -6689,7 +6808,8 @@ class LinearSweepAlgorithm(object):
             :type size: int
             :param insn: a raw buffer where are the instructions
             :type insn: string
-            :param idx: a start address in the buffer
+            :param idx: a start address in the buffer (instructions are decoded at
+                        their offset in insn, the buffer is never copied)
             :type idx: int
 
             :rtype: a generator of :class:`Instruction` objects
@@ -6707,46 +6827,144 @@ class LinearSweepAlgorithm(object):
             max_idx = len(insn)
 
         # Get instructions
+        # each instruction reads its operands through a buffer starting at
+        # its own offset: unlike insn[idx:], a buffer does not copy the rest
+        # of the method, so the decoding stays linear in the method size
 
         while idx < max_idx:
             obj = None
             classic_instruction = True
 
-            op_value = unpack('=B', insn[idx])[0]
+            view = buffer(insn, idx)
+            op_value = unpack('=B', view[0])[0]
 
             # payload instructions or extented/optimized instructions
 
             if (op_value == 0 or op_value == 255) and idx + 2 < max_idx:
-                op_value = unpack('=H', insn[idx:idx + 2])[0]
+                op_value = unpack('=H', view[0:2])[0]
 
                 # payload instructions
                 if op_value in DALVIK_OPCODES_PAYLOAD:
                     try:
-                        obj = get_instruction_payload(op_value, insn[idx:])
+                        obj = get_instruction_payload(op_value, view)
                         classic_instruction = False
                     except struct.error:
                         warning('error while decoding instruction ...')
                 elif op_value in DALVIK_OPCODES_EXTENDED_WIDTH:
                     try:
-                        obj = get_extented_instruction(cm, op_value, insn[idx:])
+                        obj = get_extented_instruction(cm, op_value, view)
                         classic_instruction = False
                     except struct.error, why:
                         warning('error while decoding instruction ...' + why.__str__())
                 elif self.odex and op_value in DALVIK_OPCODES_OPTIMIZED:
                     # optimized instructions ?
-                    obj = get_optimized_instruction(cm, op_value, insn[idx:])
+                    obj = get_optimized_instruction(cm, op_value, view)
                     classic_instruction = False
 
             # classical instructions
             if classic_instruction:
-                op_value = unpack('=B', insn[idx])[0]
-                obj = get_instruction(cm, op_value, insn[idx:], self.odex)
+                op_value = unpack('=B', view[0])[0]
+                obj = get_instruction(cm, op_value, view, self.odex)
 
             # emit instruction
             yield obj
             idx += obj.get_length()
 
 
+class InstructionsCache(object):
+
+    """
+        This class keeps the decoded instructions of the methods of a dex file
+        (or of all the dex files of an analysis), so that all the analysis
+        passes share one decoding of each method.
+        The least recently used methods are evicted when the number of cached
+        instructions exceeds the budget.
+
+        :param max_instructions: the maximum number of cached instructions (None: no limit, 0: no cache)
+        :type max_instructions: int
+    """
+
+    def __init__(self, max_instructions=None):
+        self.max_instructions = max_instructions
+
+        self.__methods = collections.OrderedDict()
+        self.nb_instructions = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def is_enabled(self):
+        return self.max_instructions != 0
+
+    def get(self, code):
+        """
+            Return the cached instructions of a method
+
+            :param code: the instructions of the method
+            :type code: :class:`DCode` object
+
+            :rtype: a list of :class:`Instruction` objects, or None
+        """
+
+        instructions = self.__methods.pop(code, None)
+        if instructions is None:
+            self.misses += 1
+            return None
+
+        # most recently used
+        self.__methods[code] = instructions
+        self.hits += 1
+        return instructions
+
+    def add(self, code, instructions):
+        """
+            Cache the instructions of a method, and evict the least recently
+            used methods if the budget is exceeded
+
+            :param code: the instructions of the method
+            :type code: :class:`DCode` object
+            :param instructions: the decoded instructions
+            :type instructions: a list of :class:`Instruction` objects
+        """
+
+        if self.max_instructions is not None and len(instructions) > self.max_instructions:
+            return
+
+        self.remove(code)
+        self.__methods[code] = instructions
+        self.nb_instructions += len(instructions)
+
+        if self.max_instructions is not None:
+            while self.nb_instructions > self.max_instructions:
+                _, evicted = self.__methods.popitem(last=False)
+                self.nb_instructions -= len(evicted)
+
+    def remove(self, code):
+        instructions = self.__methods.pop(code, None)
+        if instructions is not None:
+            self.nb_instructions -= len(instructions)
+
+    def clear(self):
+        self.__methods.clear()
+        self.nb_instructions = 0
+
+    def get_hit_rate(self):
+        """
+            Return the ratio of the lookups which have been served by the cache
+
+            :rtype: float
+        """
+
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def show(self):
+        print 'instructions cache: %d methods, %d instructions, %d hits, %d misses (hit rate %.2f%%)' % (
+            len(self.__methods), self.nb_instructions, self.hits, self.misses, self.get_hit_rate() * 100)
+
+
 class DCode(object):
 
     """
@@ -6792,6 +7010,7 @@ class DCode(object):
 
         self.insn = insn
         self.size = len(self.insn)
+        self.CM.get_instructions_cache().remove(self)
 
     def set_idx(self, idx):
         """
@@ -6802,6 +7021,7 @@ class DCode(object):
         """
 
         self.idx = idx
+        self.CM.get_instructions_cache().remove(self)
 
     def is_cached_instructions(self):
         if self.cached_instructions:
@@ -6827,11 +7047,31 @@ class DCode(object):
         if self.cached_instructions:
             for i in self.cached_instructions:
                 yield i
-        else:
+            return
+
+        # the decoded instructions are shared by all the analysis passes
+        cache = self.CM.get_instructions_cache()
+        if not cache.is_enabled():
             lsa = LinearSweepAlgorithm()
             for i in lsa.get_instructions(self.CM, self.size, self.insn,
                                           self.idx):
                 yield i
+            return
+
+        instructions = cache.get(self)
+        if instructions is None:
+            # yielded as they are decoded, the instructions before an invalid
+            # one are still given (the method is then not cached)
+            instructions = []
+            lsa = LinearSweepAlgorithm()
+            for i in lsa.get_instructions(self.CM, self.size, self.insn, self.idx):
+                instructions.append(i)
+                yield i
+            cache.add(self, instructions)
+            return
+
+        for i in instructions:
+            yield i
 
     def reload(self):
         pass
@@ -7297,10 +7537,19 @@ class CodeItem(object):
         return length
 
 
+# the sections which are not needed to load the classes and their code:
+# with the lazy analysis they are only parsed when they are accessed
+LAZY_MAP_ITEMS = ['TYPE_ANNOTATION_ITEM',
+                  'TYPE_ANNOTATION_SET_ITEM',
+                  'TYPE_ANNOTATIONS_DIRECTORY_ITEM',
+                  'TYPE_ANNOTATION_SET_REF_LIST']
+
+
 class MapItem(object):
 
     def __init__(self, buff, cm):
         self.__CM = cm
+        self.__buff = buff
 
         self.off = buff.get_idx()
 
@@ -7310,10 +7559,34 @@ class MapItem(object):
         self.offset = unpack('=I', buff.read(4))[0]
 
         self.item = None
+        self.__loaded = True
 
         buff.set_idx(self.offset)
 
-        self.next(buff, cm)
+        if cm.lazy_analysis and TYPE_MAP_ITEM.get(self.type) in LAZY_MAP_ITEMS:
+            # only (offset, size) is kept until the first access
+            self.__loaded = False
+        else:
+            self.next(buff, cm)
+
+    def is_loaded(self):
+        return self.__loaded
+
+    def load(self):
+        """
+            Parse the items of a lazy map item (see LAZY_MAP_ITEMS)
+        """
+        if self.__loaded:
+            return
+        self.__loaded = True
+
+        idx = self.__buff.get_idx()
+        self.__buff.set_idx(self.offset)
+        self.next(self.__buff, self.__CM)
+        self.__buff.set_idx(idx)
+
+        self.__CM.add_type_item(TYPE_MAP_ITEM[self.type], self, self.item)
+        self.reload()
 
     def next(self, buff, cm):
         if TYPE_MAP_ITEM[self.type] == 'TYPE_HEADER_ITEM':
@@ -7358,6 +7631,9 @@ class MapItem(object):
             bytecode.Exit('Map item %d @ 0x%x(%d) is unknown' % (self.type, buff.get_idx(), buff.get_idx()))
 
     def reload(self):
+        if not self.__loaded:
+            return
+
         if isinstance(self.item, list):
             for i in self.item:
                 i.reload()
@@ -7365,6 +7641,7 @@ class MapItem(object):
             self.item.reload()
 
     def show(self):
+        self.load()
         bytecode._Print('\tMAP_TYPE_ITEM', TYPE_MAP_ITEM[self.type])
 
         if self.item is not None:
@@ -7375,6 +7652,7 @@ class MapItem(object):
                 self.item.show()
 
     def pretty_show(self):
+        self.load()
         bytecode._Print('\tMAP_TYPE_ITEM', TYPE_MAP_ITEM[self.type])
 
         if self.item is not None:
@@ -7388,9 +7666,11 @@ class MapItem(object):
                 self.item.show()
 
     def get_obj(self):
+        self.load()
         return self.item
 
     def get_raw(self):
+        self.load()
         if isinstance(self.item, list):
             self.offset = self.item[0].get_off()
         else:
@@ -7404,6 +7684,7 @@ class MapItem(object):
         return calcsize('=HHII')
 
     def get_item(self):
+        self.load()
         return self.item
 
     def set_item(self, item):
@@ -7443,12 +7724,20 @@ class ClassManager(object):
 
         self.__manage_item = {}
         self.__manage_item_off = []
+        self.__manage_item_off_sorted = True
+
+        # offset -> item, filled by add_type_item
+        self.__class_data_items = {}
+        self.__encoded_array_items = {}
+        self.__type_lists = {}
 
         self.__strings_off = {}
 
         self.__obj_offset = {}
         self.__item_offset = {}
 
+        self.__lazy_items = []
+
         self.__cached_proto = {}
 
         self.recode_ascii_string = config["RECODE_ASCII_STRING"]
@@ -7458,6 +7747,8 @@ class ClassManager(object):
 
         self.lazy_analysis = config["LAZY_ANALYSIS"]
 
+        self.instructions_cache = InstructionsCache(config["INSTRUCTIONS_CACHE_SIZE"])
+
         self.hook_strings = {}
 
         if self.vm:
@@ -7479,10 +7770,23 @@ class ClassManager(object):
     def get_odex_format(self):
         return self.odex_format
 
+    def get_instructions_cache(self):
+        return self.instructions_cache
+
+    def set_instructions_cache(self, instructions_cache):
+        """
+            Share the cache (and its budget) of another dex file
+        """
+        self.instructions_cache = instructions_cache
+
     def get_obj_by_offset(self, offset):
+        if offset not in self.__obj_offset:
+            self.load_lazy_type_items()
         return self.__obj_offset[offset]
 
     def get_item_by_offset(self, offset):
+        if offset not in self.__item_offset:
+            self.load_lazy_type_items()
         return self.__item_offset[offset]
 
     def get_string_by_offset(self, offset):
@@ -7506,6 +7810,21 @@ class ClassManager(object):
     def get_all_engine(self):
         return self.engine
 
+    def add_lazy_type_item(self, mi):
+        """
+            Register a map item whose items are not parsed yet: only the
+            offset of its section is known
+        """
+        self.__lazy_items.append(mi)
+
+        self.__obj_offset[mi.get_off()] = mi
+        self.__manage_item_off.append(mi.get_offset())
+        self.__manage_item_off_sorted = False
+
+    def load_lazy_type_items(self):
+        while self.__lazy_items:
+            self.__lazy_items.pop().load()
+
     def add_type_item(self, type_item, mi, c_item):
         self.__manage_item[type_item] = c_item
 
@@ -7527,6 +7846,17 @@ class ClassManager(object):
                     self.__strings_off[goff] = i
         else:
             self.__manage_item_off.append(mi.get_offset())
+        self.__manage_item_off_sorted = False
+
+        if type_item == 'TYPE_CLASS_DATA_ITEM':
+            for i in c_item:
+                self.__class_data_items.setdefault(i.get_off(), i)
+        elif type_item == 'TYPE_ENCODED_ARRAY_ITEM':
+            for i in c_item:
+                self.__encoded_array_items.setdefault(i.get_off(), i)
+        elif type_item == 'TYPE_TYPE_LIST':
+            for i in c_item:
+                self.__type_lists.setdefault(i.get_type_list_off(), i)
 
     def get_code(self, idx):
         try:
@@ -7535,16 +7865,13 @@ class ClassManager(object):
             return None
 
     def get_class_data_item(self, off):
-        for i in self.__manage_item['TYPE_CLASS_DATA_ITEM']:
-            if i.get_off() == off:
-                return i
-
-        bytecode.Exit('unknown class data item @ 0x%x' % off)
+        try:
+            return self.__class_data_items[off]
+        except KeyError:
+            bytecode.Exit('unknown class data item @ 0x%x' % off)
 
     def get_encoded_array_item(self, off):
-        for i in self.__manage_item['TYPE_ENCODED_ARRAY_ITEM']:
-            if i.get_off() == off:
-                return i
+        return self.__encoded_array_items.get(off)
 
     def get_string(self, idx):  # id is index, not offset
         if idx in self.hook_strings:
@@ -7579,9 +7906,9 @@ class ClassManager(object):
         if off == 0:
             return []
 
-        for i in self.__manage_item['TYPE_TYPE_LIST']:
-            if i.get_type_list_off() == off:
-                return [type_.get_string() for type_ in i.get_list()]
+        i = self.__type_lists.get(off)
+        if i is not None:
+            return [type_.get_string() for type_ in i.get_list()]
 
     def get_type(self, idx):    # idx is index
         _type = self.__manage_item['TYPE_TYPE_ID_ITEM'].get(idx)
@@ -7640,6 +7967,13 @@ class ClassManager(object):
         for i in class_def.get_fields():
             i.reload()
 
+        # the subclasses of the dex file have the new superclass name
+        for i in self.vm.get_classes():
+            if i.get_superclass_idx() == class_def.get_class_idx():
+                i.sname = self.get_type(i.get_superclass_idx())
+
+        self.vm._invalidate_class_cache()
+
         if python_export:
             self.vm._create_python_export_class(class_def)
 
@@ -7696,6 +8030,7 @@ class ClassManager(object):
                 debug('skipping creating new name in python')
 
         method.reload()
+        self.vm._invalidate_class_cache()
 
     def set_hook_field_name(self, encoded_field, value):
         python_export = True
@@ -7724,14 +8059,19 @@ class ClassManager(object):
                 setattr(class_def, name, encoded_field)
 
         field.reload()
+        self.vm._invalidate_class_cache()
 
     def set_hook_string(self, idx, value):
         self.hook_strings[idx] = value
 
     def get_next_offset_item(self, idx):
-        for i in self.__manage_item_off:
-            if i > idx:
-                return i
+        if not self.__manage_item_off_sorted:
+            self.__manage_item_off.sort()
+            self.__manage_item_off_sorted = True
+
+        i = bisect.bisect_right(self.__manage_item_off, idx)
+        if i < len(self.__manage_item_off):
+            return self.__manage_item_off[i]
         return idx
 
     def get_debug_off(self, off):
@@ -7763,7 +8103,11 @@ class MapList(object):
             self.map_item.append(mi)
 
             buff.set_idx(idx + mi.get_length())
-        
+
+            if not mi.is_loaded():
+                self.CM.add_lazy_type_item(mi)
+                continue
+
             c_item = mi.get_item()
             if not c_item:
                 mi.set_item(self)
@@ -7851,14 +8195,144 @@ class DREF(object):
         self.items.append((x, y))
 
 
+# invoke-kind {vC, vD, vE, vF, vG}, meth@BBBB, invoke-kind/range and the jumbo invokes
+INVOKE_OPCODES = frozenset(range(0x6e, 0x73) + range(0x74, 0x79) + range(0x22ff, 0x2700))
+
+
+class CallSites(object):
+
+    """
+        This class is the table of the invoke instructions of a dex file, in
+        columns: the calling method, the offset of the instruction, the index
+        of the called method and the opcode of the invoke. The rows of a
+        method are added the first time its call sites are asked for, so only
+        the methods which are looked at are decoded.
+
+        :param vm: a :class:`DalvikVMFormat` object
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+
+        self.methods = []                   # EncodedMethod
+        self.offsets = array.array('i')
+        self.method_idx = array.array('i')
+        self.kinds = array.array('H')       # opcode value
+
+        # EncodedMethod -> (first row, last row + 1)
+        self.__rows = {}
+        # all the methods are in the table
+        self.__complete = False
+
+        # called method name -> call sites
+        self.__callees = None
+
+    def __add_method(self, current_method):
+        rows = self.__rows.get(current_method)
+        if rows is not None:
+            return rows
+
+        start = len(self.methods)
+        code = current_method.get_code()
+        if code is not None:
+            off = 0
+            try:
+                for instruction in code.get_bc().get_instructions():
+                    op_value = instruction.get_op_value()
+                    if op_value in INVOKE_OPCODES:
+                        self.methods.append(current_method)
+                        self.offsets.append(off)
+                        self.method_idx.append(instruction.get_ref_kind())
+                        self.kinds.append(op_value)
+                    off += instruction.get_length()
+            except InvalidInstruction as e:
+                warning("Invalid instruction %s" % str(e))
+
+        rows = self.__rows[current_method] = (start, len(self.methods))
+        return rows
+
+    def __add_all(self):
+        if not self.__complete:
+            for current_class in self.vm.get_classes():
+                for current_method in current_class.get_methods():
+                    self.__add_method(current_method)
+            self.__complete = True
+
+    def __len__(self):
+        self.__add_all()
+        return len(self.methods)
+
+    def get(self, idx):
+        """
+            Return a call site
+
+            :param idx: the position of the call site
+            :rtype: a tuple (calling :class:`EncodedMethod`, offset, called method index, opcode)
+        """
+        return self.methods[idx], self.offsets[idx], self.method_idx[idx], self.kinds[idx]
+
+    def gets(self, methods=None):
+        """
+            Return the call sites of some methods, in the order of the methods
+            and of their instructions
+
+            :param methods: a list of :class:`EncodedMethod` objects (all the
+                            methods of the classes by default)
+            :rtype: an iterator of tuples (calling :class:`EncodedMethod`, offset, called method index, opcode)
+        """
+        if methods is None:
+            methods = (current_method for current_class in self.vm.get_classes()
+                       for current_method in current_class.get_methods())
+        for current_method in methods:
+            start, end = self.__add_method(current_method)
+            for idx in xrange(start, end):
+                yield self.get(idx)
+
+    def get_callers(self, method_name, class_name=None, descriptor=None):
+        """
+            Return the call sites of a method
+
+            :param method_name: the name of the called method
+            :param class_name: the class of the called method (any class by default)
+            :param descriptor: the descriptor of the called method (any descriptor by default)
+            :rtype: a list of tuples (calling :class:`EncodedMethod`, offset, called method index, opcode)
+        """
+        if self.__callees is None:
+            self.__add_all()
+            self.__callees = {}
+            for idx in xrange(len(self.methods)):
+                method_info = self.vm.get_cm_method(self.method_idx[idx])
+                if method_info:
+                    self.__callees.setdefault(method_info[1], []).append(idx)
+
+        l = []
+        for idx in self.__callees.get(method_name, []):
+            if class_name is not None or descriptor is not None:
+                method_info = self.vm.get_cm_method(self.method_idx[idx])
+                if class_name is not None and method_info[0] != class_name:
+                    continue
+                if descriptor is not None and ''.join(method_info[2]) != descriptor:
+                    continue
+            l.append(self.get(idx))
+        return l
+
+    def reset_callees(self):
+        """
+            Forget the names of the called methods (a method has been renamed)
+        """
+        self.__callees = None
+
+
 class DalvikVMFormat(bytecode._Bytecode):
 
     """
         This class can parse a classes.dex file of an Android application (APK).
-        :param buff: a string which represents the classes.dex file
+        :param buff: a string which represents the classes.dex file, or a
+                     read-only buffer over a mapped file (see bytecode.read_mmap)
         :type buff: string
         :Example:
           DalvikVMFormat( read("classes.dex") )
+          DalvikVMFormat( bytecode.read_mmap("classes.dex") )
     """
 
     def __init__(self, buff):
@@ -7866,13 +8340,20 @@ class DalvikVMFormat(bytecode._Bytecode):
 
         self.config = {'RECODE_ASCII_STRING': CONF['RECODE_ASCII_STRING'],
                        'RECODE_ASCII_STRING_METH': CONF['RECODE_ASCII_STRING_METH'],
-                       'LAZY_ANALYSIS': CONF['LAZY_ANALYSIS']}
+                       'LAZY_ANALYSIS': CONF['LAZY_ANALYSIS'],
+                       'INSTRUCTIONS_CACHE_SIZE': CONF['INSTRUCTIONS_CACHE_SIZE']}
         self.CM = ClassManager(self, self.config)
         self._load()
         self.classes_names = None
         self.__cache_methods = None
         self.__cached_methods_idx = None
         self.__cache_fields = None
+        self.__cache_classes = None
+        self.__cache_class_methods = None
+        self.__cache_class_fields = None
+        self.__call_sites = None
+        # called by _invalidate_class_cache
+        self.__class_cache_callbacks = []
 
     def _load(self):
         self.__header = HeaderItem(self, ClassManager(None, self.config))
@@ -8042,10 +8523,53 @@ class DalvikVMFormat(bytecode._Bytecode):
           :rtype: a :class:`ClassDefItem` object
         """
 
-        for i in self.classes.class_def:
-            if i.get_name() == name:
-                return i
-        return None
+        if self.__cache_classes is None:
+            self.__cache_classes = {}
+            for i in self.classes.class_def:
+                self.__cache_classes.setdefault(i.get_name(), []).append(i)
+
+        try:
+            return self.__cache_classes[name][0]
+        except KeyError:
+            return None
+
+    def _invalidate_class_cache(self):
+        """
+            Forget the name indexes of the classes, methods and fields
+            (a class, method or field has been renamed)
+        """
+
+        self.classes_names = None
+        self.__cache_methods = None
+        self.__cache_fields = None
+        self.__cache_classes = None
+        self.__cache_class_methods = None
+        self.__cache_class_fields = None
+        if self.__call_sites is not None:
+            self.__call_sites.reset_callees()
+        for callback in self.__class_cache_callbacks:
+            callback()
+
+    def add_class_cache_callback(self, callback):
+        """
+            Register a function called without argument each time a class,
+            method or field is renamed, to forget the indexes built on the
+            names outside of this object
+
+            :param callback: a function
+        """
+
+        self.__class_cache_callbacks.append(callback)
+
+    def get_call_sites(self):
+        """
+          Return the invoke instructions of all the methods
+
+          :rtype: a :class:`CallSites` object
+        """
+        if self.__call_sites is None:
+            self.__call_sites = CallSites(self)
+        return self.__call_sites
 
     def get_method(self, name):
         """
@@ -8112,16 +8636,21 @@ class DalvikVMFormat(bytecode._Bytecode):
                 l.append(j)
         return l
 
-    def get_methods(self, framework_classes):
+    def get_methods(self, framework_classes=None):
         """
           Return all method objects
 
+          :param framework_classes: the package prefixes (or a :class:`FrameworkClasses` object)
+                                    of the classes which are discarded
           :rtype: a list of :class:`EncodedMethod` objects
         """
+        if not isinstance(framework_classes, FrameworkClasses):
+            framework_classes = get_framework_classes(framework_classes)
+
         l = []
         # discard the methods of Android Frameworks packages
         for i in self.classes.class_def:
-            if self.framework_class(i.name,framework_classes):
+            if framework_classes.is_framework_class(i.name):
                 continue
             for j in i.get_methods():
                 l.append(j)
@@ -8129,6 +8658,8 @@ class DalvikVMFormat(bytecode._Bytecode):
 
     @staticmethod
     def framework_class(class_name, framework_classes):
+        if isinstance(framework_classes, FrameworkClasses):
+            return framework_classes.is_framework_class(class_name)
         for framework_class in framework_classes:
             if class_name.find(framework_class) == 0:
                 return True
@@ -8205,12 +8736,13 @@ class DalvikVMFormat(bytecode._Bytecode):
             :rtype: None or a :class:`EncodedMethod` object
         """
 
+        self.get_class(class_name)
+
         l = []
-        for i in self.classes.class_def:
-            if i.get_name() == class_name:
-                for j in i.get_methods():
-                    if j.get_name() == method_name:
-                        l.append(j)
+        for i in self.__cache_classes.get(class_name, []):
+            for j in i.get_methods():
+                if j.get_name() == method_name:
+                    l.append(j)
 
         return l
 
@@ -8224,13 +8756,13 @@ class DalvikVMFormat(bytecode._Bytecode):
             :rtype: a list with :class:`EncodedMethod` objects
         """
 
-        l = []
-        for i in self.classes.class_def:
-            for j in i.get_methods():
-                if class_name == j.get_class_name():
-                    l.append(j)
+        if self.__cache_class_methods is None:
+            self.__cache_class_methods = {}
+            for i in self.classes.class_def:
+                for j in i.get_methods():
+                    self.__cache_class_methods.setdefault(j.get_class_name(), []).append(j)
 
-        return l
+        return list(self.__cache_class_methods.get(class_name, []))
 
     def get_fields_class(self, class_name):
         """
@@ -8242,13 +8774,13 @@ class DalvikVMFormat(bytecode._Bytecode):
             :rtype: a list with :class:`EncodedField` objects
         """
 
-        l = []
-        for i in self.classes.class_def:
-            for j in i.get_fields():
-                if class_name == j.get_class_name():
-                    l.append(j)
+        if self.__cache_class_fields is None:
+            self.__cache_class_fields = {}
+            for i in self.classes.class_def:
+                for j in i.get_fields():
+                    self.__cache_class_fields.setdefault(j.get_class_name(), []).append(j)
 
-        return l
+        return list(self.__cache_class_fields.get(class_name, []))
 
     def get_field_descriptor(
         self,
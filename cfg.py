@@ -3,15 +3,35 @@
 
 import os
 import os.path
+import gzip
+import shutil
+import hashlib
+import zipfile
+import select
+import signal
+import multiprocessing
 from optparse import OptionParser
 from androguard.core.bytecodes import apk, dvm
 from androguard.core.analysis import analysis
 from cfg import graphAnalysis
 from androguard.core import androconf
-from time import clock
+from time import clock, time
 
 option_0 = {'name': ('-i', '--input'), 'help': 'filename input (dex, apk)', 'nargs': 1}
-options_io = [option_0]
+option_1 = {'name': ('-z', '--gzip'), 'help': 'write gzip-compressed dot files (.dot.gz)', 'action': 'store_true'}
+option_2 = {'name': ('-b', '--binary'), 'help': 'write the binary graph (.icfg) instead of the dot file', 'action': 'store_true'}
+option_3 = {'name': ('-j', '--jobs'), 'help': 'number of apk files analyzed in parallel', 'type': 'int', 'default': 1}
+option_4 = {'name': ('-k', '--maxtasksperchild'), 'help': 'number of apk files analyzed by a worker before it is replaced',
+            'type': 'int', 'default': 20}
+option_5 = {'name': ('-t', '--timeout'), 'help': 'maximum number of seconds to analyze one apk file (0: no limit)',
+            'type': 'int', 'default': 0}
+option_6 = {'name': ('-c', '--cache'), 'help': 'directory of the results, keyed by the digest of the dex files', 'nargs': 1}
+option_7 = {'name': ('-p', '--processes'), 'help': 'number of processes which build the basic blocks of an apk file',
+            'type': 'int', 'default': 1}
+options_io = [option_0, option_1, option_2, option_3, option_4, option_5, option_6, option_7]
+
+# change it when the analysis changes, the results in the cache are then ignored
+CACHE_VERSION = 1
 
 registration_callback = {}
 
@@ -25,9 +45,63 @@ def get_registration_callback():
             registration_callback[reg][pos] = callback
 
 
-def one_apk_file_analysis(base_path):
-    if os.path.isfile(base_path[:-3] + 'dot'):
-        return
+def get_cache_key(base_path, suffix):
+    """
+        Return the key of the result of an apk file in the cache: the sha256
+        of its dex files and of the configuration of the analysis. Renamed,
+        duplicated or repackaged apps with the same code share their result.
+
+        :param suffix: the suffix of the output (dot, dot.gz or icfg)
+        :rtype: a string, or None if the apk file has no dex file
+    """
+    digest = hashlib.sha256()
+    digest.update('%d %s %r\n' % (CACHE_VERSION, suffix, androconf.CONF['LIBRARY_CLASSES']))
+    try:
+        with zipfile.ZipFile(base_path) as z:
+            names = set(z.namelist())
+            # the dex files of APK.get_all_dex, in the same order
+            dex, i = 'classes.dex', 2
+            if dex not in names:
+                return None
+            while dex in names:
+                digest.update(hashlib.sha256(z.read(dex)).digest())
+                dex, i = 'classes%d.dex' % i, i + 1
+    except (IOError, zipfile.BadZipfile):
+        return None
+    return digest.hexdigest()
+
+
+def get_cache_path(cache_dir, key, suffix):
+    return os.path.join(cache_dir, key[:2], key + '.' + suffix)
+
+
+def copy_file(src, dst):
+    # the copy is renamed once complete, the other workers never see a part of it
+    tmp = '%s.%d.tmp' % (dst, os.getpid())
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dst)
+
+
+def one_apk_file_analysis(base_path, compress=False, binary=False, cache_dir=None):
+    if binary:
+        suffix = 'icfg'
+    else:
+        suffix = 'dot.gz' if compress else 'dot'
+    output = base_path[:-3] + suffix
+
+    cached = None
+    if cache_dir is None:
+        if os.path.isfile(output):
+            return
+    else:
+        # an existing output is replaced if its apk file has changed
+        key = get_cache_key(base_path, suffix)
+        if key is not None:
+            cached = get_cache_path(cache_dir, key, suffix)
+            if os.path.isfile(cached):
+                copy_file(cached, output)
+                print 'the file ' + base_path + ' is served from the cache'
+                return
     if not base_path:
         useage()
     start = clock()
@@ -43,27 +117,170 @@ def one_apk_file_analysis(base_path):
                 vmx.add(vm)
         if vmx is not None:
             # vmx.construct_class_hierarchy()
-            vmx.intro_procedural_cfg()
-            vmx.explicit_icfg()
+            # the cfg and the explicit icfg in one pass over the instructions
+            vmx.analyze(xref=False)
             # vmx.implicit_icfg(registration_callback)
-            with open(base_path[:-3] + 'dot', 'w') as f:
-                f.write(vmx.export_to_dot())
+            # the outputs only need the blocks
+            vmx.clear_instructions_cache()
+            if binary:
+                # reloaded with CompactICFG.load, the edges of the blocks
+                # are released as they are converted
+                vmx.get_compact_icfg(release=True).save(output)
+            else:
+                # the edges are written as they are found, in a temporary
+                # file so that an interrupted analysis is not skipped later
+                tmp = output + '.tmp'
+                with (gzip.open(tmp, 'wb') if compress else open(tmp, 'w')) as f:
+                    vmx.write_dot(f)
+                os.rename(tmp, output)
+            if cached is not None:
+                if not os.path.isdir(os.path.dirname(cached)):
+                    try:
+                        os.makedirs(os.path.dirname(cached))
+                    except OSError:
+                        # created by another worker
+                        pass
+                copy_file(output, cached)
         end = clock()
         print 'Analyzing the file ' + base_path + ' cost : ' + str(end-start) + "s"
     else:
         print 'the file ' + base_path + ' is a invalid apk file'
 
 
-def many_apk_file_analysis(base_dir):
-    if not base_dir:
-        useage()
+def _analysis_task(task):
+    base_path, compress, binary, cache_dir = task
+    try:
+        one_apk_file_analysis(base_path, compress, binary, cache_dir)
+    except Exception as e:
+        # one broken apk file does not stop the others
+        print 'Analyzing the file ' + base_path + ' failed : ' + repr(e)
+
+
+def _worker(conn, maxtasksperchild):
+    # the processes of the worker (see -p) are killed with it
+    os.setpgrp()
+    nb = 0
+    while maxtasksperchild is None or nb < maxtasksperchild:
+        task = conn.recv()
+        if task is None:
+            break
+        _analysis_task(task)
+        conn.send(None)
+        nb += 1
+    conn.close()
+
+
+def _start_worker(maxtasksperchild):
+    conn, child_conn = multiprocessing.Pipe()
+    # not a daemon: it can start the pool of intro_procedural_cfg
+    process = multiprocessing.Process(target=_worker, args=(child_conn, maxtasksperchild))
+    process.start()
+    # the pipe is closed if the worker dies
+    child_conn.close()
+    # [process, pipe, apk file, start time, number of apk files]
+    return [process, conn, None, None, 0]
+
+
+def _kill_worker(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        process.terminate()
+
+
+def _run_workers(tasks, jobs, maxtasksperchild, timeout):
+    """
+        Analyze the tasks in jobs worker processes. A worker is replaced once
+        it has analyzed maxtasksperchild apk files, and it is killed (and
+        replaced) by this process if an apk file takes more than timeout
+        seconds: the analysis itself is never trusted to stop.
+    """
+    tasks = iter(tasks)
+    pending = True
+    workers = []
+    try:
+        while True:
+            while pending and len(workers) < jobs:
+                workers.append(_start_worker(maxtasksperchild))
+            for w in workers:
+                if pending and w[2] is None:
+                    task = next(tasks, None)
+                    if task is None:
+                        pending = False
+                    else:
+                        w[1].send(task)
+                        w[2], w[3] = task[0], time()
+
+            busy = [w for w in workers if w[2] is not None]
+            if not busy:
+                break
+            ready = select.select([w[1] for w in busy], [], [], 0.5)[0]
+            now = time()
+            for w in busy:
+                process, conn, base_path, start, nb = w
+                if conn in ready:
+                    try:
+                        conn.recv()
+                    except EOFError:
+                        print 'Analyzing the file ' + base_path + ' failed : the worker has died'
+                    else:
+                        w[2], w[3], w[4] = None, None, nb + 1
+                        if maxtasksperchild is None or w[4] < maxtasksperchild:
+                            continue
+                elif timeout and now - start > timeout:
+                    _kill_worker(process)
+                    print 'Analyzing the file ' + base_path + ' timed out after ' + str(timeout) + 's'
+                else:
+                    continue
+                # the worker has exited, died or been killed
+                process.join()
+                conn.close()
+                workers.remove(w)
+    finally:
+        for process, conn, base_path, _, _ in workers:
+            if base_path is None:
+                try:
+                    conn.send(None)
+                except (IOError, OSError):
+                    pass
+            else:
+                _kill_worker(process)
+        for w in workers:
+            w[0].join()
+
+
+def get_apk_files(base_dir):
     for root, dirs, files in os.walk(base_dir):
         for dr in dirs:
             for r, d, fs in os.walk(base_dir + os.sep + dr):
                 for f in fs:
                     if f.endswith(".apk"):
-                        current_apk_file = base_dir + os.sep + dr + os.sep + f
-                        one_apk_file_analysis(current_apk_file)
+                        yield base_dir + os.sep + dr + os.sep + f
+
+
+def many_apk_file_analysis(base_dir, compress=False, binary=False, jobs=1, maxtasksperchild=None, timeout=0,
+                           cache_dir=None):
+    """
+        Analyze the apk files of the subdirectories of base_dir
+
+        :param jobs: the number of worker processes (1: in this process,
+                     unless there is a timeout)
+        :param maxtasksperchild: the number of apk files analyzed by a worker
+                                 before it is replaced, to give back its memory
+        :param timeout: the maximum number of seconds to analyze one apk file (0: no limit)
+        :param cache_dir: the directory of the results keyed by the digest of
+                          the dex files (None: no cache)
+    """
+    if not base_dir:
+        useage()
+    tasks = ((current_apk_file, compress, binary, cache_dir) for current_apk_file in get_apk_files(base_dir))
+    if jobs <= 1 and not timeout:
+        for task in tasks:
+            _analysis_task(task)
+        return
+
+    # the timeout is enforced from this process, so even one job runs in a worker
+    _run_workers(tasks, max(jobs, 1), maxtasksperchild, timeout)
 
 
 def useage():
@@ -83,11 +300,17 @@ if __name__ == '__main__':
         parser.add_option(*param, **option)
 
     (option_input_output, _) = parser.parse_args()
+    # only the classes, methods and code are needed to build the cfg
+    androconf.set_lazy()
+    androconf.CONF['CFG_PROCESSES'] = option_input_output.processes
     # get_registration_callback()
 
     # change if you want to analysis one apk or lots of apks
-    many_apk_file_analysis(option_input_output.input)
-    # one_apk_file_analysis(option_input_output.input)
+    many_apk_file_analysis(option_input_output.input, option_input_output.gzip, option_input_output.binary,
+                           option_input_output.jobs, option_input_output.maxtasksperchild, option_input_output.timeout,
+                           option_input_output.cache)
+    # one_apk_file_analysis(option_input_output.input, option_input_output.gzip, option_input_output.binary,
+    #                       option_input_output.cache)
     time_end = clock()
     print 'all the time cost is : ' + str(time_end-time_begin) + 's'
 
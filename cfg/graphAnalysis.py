@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cStringIO
 from xml.sax.saxutils import escape
 
 from androguard.core import bytecode
@@ -1470,91 +1471,86 @@ class CFGAnalysis(object):
             n1.set_attributes(H)
 
     def export_to_gexf(self):
-        buff = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        buff += \
-            '<gexf xmlns="http://www.gephi.org/gexf" xmlns:viz="http://www.gephi.org/gexf/viz">\n'
-        buff += '<graph type="static">\n'
+        buff = cStringIO.StringIO()
+        self.write_gexf(buff)
+        return buff.getvalue()
 
-        buff += '<attributes class="node" type="static">\n'
-        buff += \
-            '<attribute default="normal" id="%d" title="type" type="string"/>\n' \
-            % ID_ATTRIBUTES['type']
-        buff += \
-            '<attribute id="%d" title="class_name" type="string"/>\n' \
-            % ID_ATTRIBUTES['class_name']
-        buff += \
-            '<attribute id="%d" title="method_name" type="string"/>\n' \
-            % ID_ATTRIBUTES['method_name']
-        buff += \
-            '<attribute id="%d" title="descriptor" type="string"/>\n' \
-            % ID_ATTRIBUTES['descriptor']
+    def write_gexf(self, f):
+        """
+            Write the graph in the gexf format to a file object, node by node
 
-        buff += \
-            '<attribute default="0" id="%d" title="permissions" type="integer"/>\n' \
-            % ID_ATTRIBUTES['permissions']
-        buff += \
-            '<attribute default="normal" id="%d" title="permissions_level" type="string"/>\n' \
-            % ID_ATTRIBUTES['permissions_level']
+            :param f: a file object
+        """
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<gexf xmlns="http://www.gephi.org/gexf" xmlns:viz="http://www.gephi.org/gexf/viz">\n')
+        f.write('<graph type="static">\n')
 
-        buff += \
-            '<attribute default="false" id="%d" title="dynamic_code" type="boolean"/>\n' \
-            % ID_ATTRIBUTES['dynamic_code']
-        buff += '</attributes>\n'
-
-        buff += '<nodes>\n'
-        for node in self.G.nodes():
-            buff += '<node id="%d" label="%s">\n' % (node,
-                    escape(self.nodes_id[node].label))
-            buff += self.nodes_id[node].get_attributes_gexf()
-            buff += '</node>\n'
-        buff += '</nodes>\n'
-
-        buff += '<edges>\n'
-        nb = 0
-        for edge in self.G.edges():
-            buff += '<edge id="%d" source="%d" target="%d"/>\n' % (nb,
-                    edge[0], edge[1])
-            nb += 1
-        buff += '</edges>\n'
-
-        buff += '</graph>\n'
-        buff += '</gexf>\n'
+        f.write('<attributes class="node" type="static">\n')
+        f.write('<attribute default="normal" id="%d" title="type" type="string"/>\n' % ID_ATTRIBUTES['type'])
+        f.write('<attribute id="%d" title="class_name" type="string"/>\n' % ID_ATTRIBUTES['class_name'])
+        f.write('<attribute id="%d" title="method_name" type="string"/>\n' % ID_ATTRIBUTES['method_name'])
+        f.write('<attribute id="%d" title="descriptor" type="string"/>\n' % ID_ATTRIBUTES['descriptor'])
 
-        return buff
+        f.write('<attribute default="0" id="%d" title="permissions" type="integer"/>\n'
+                % ID_ATTRIBUTES['permissions'])
+        f.write('<attribute default="normal" id="%d" title="permissions_level" type="string"/>\n'
+                % ID_ATTRIBUTES['permissions_level'])
 
-    def export_to_gml(self):
-        buff = \
-            '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
-        buff += \
-            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:y="http://www.yworks.com/xml/graphml" xmlns:yed="http://www.yworks.com/xml/yed/3" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://www.yworks.com/xml/schema/graphml/1.1/ygraphml.xsd">\n'
+        f.write('<attribute default="false" id="%d" title="dynamic_code" type="boolean"/>\n'
+                % ID_ATTRIBUTES['dynamic_code'])
+        f.write('</attributes>\n')
 
-        buff += \
-            '<key attr.name="description" attr.type="string" for="node" id="d5"/>\n'
-        buff += '<key for="node" id="d6" yfiles.type="nodegraphics"/>\n'
+        f.write('<nodes>\n')
+        for node in self.G.nodes_iter():
+            n = self.nodes_id[node]
+            f.write('<node id="%d" label="%s">\n' % (node, n.get_escaped()['label']))
+            f.write(n.get_attributes_gexf())
+            f.write('</node>\n')
+        f.write('</nodes>\n')
 
-        buff += '<graph edgedefault="directed" id="G">\n'
+        f.write('<edges>\n')
+        for nb, edge in enumerate(self.G.edges_iter()):
+            f.write('<edge id="%d" source="%d" target="%d"/>\n' % (nb, edge[0], edge[1]))
+        f.write('</edges>\n')
 
-        for node in self.G.nodes():
-            buff += '<node id="%d">\n' % node
+        f.write('</graph>\n')
+        f.write('</gexf>\n')
 
-            # fd.write( "<node id=\"%d\" label=\"%s\">\n" % (node, escape(self.nodes_id[ node ].label)) )
+    def export_to_gml(self):
+        buff = cStringIO.StringIO()
+        self.write_gml(buff)
+        return buff.getvalue()
 
-            buff += self.nodes_id[node].get_attributes_gml()
-            buff += '</node>\n'
+    def write_gml(self, f):
+        """
+            Write the graph in the graphml format to a file object, node by node
 
-        nb = 0
-        for edge in self.G.edges():
-            buff += '<edge id="%d" source="%d" target="%d"/>\n' % (nb,
-                    edge[0], edge[1])
-            nb += 1
+            :param f: a file object
+        """
+        f.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n')
+        f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:y="http://www.yworks.com/xml/graphml" xmlns:yed="http://www.yworks.com/xml/yed/3" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://www.yworks.com/xml/schema/graphml/1.1/ygraphml.xsd">\n')
 
-        buff += '</graph>\n'
-        buff += '</graphml>\n'
+        f.write('<key attr.name="description" attr.type="string" for="node" id="d5"/>\n')
+        f.write('<key for="node" id="d6" yfiles.type="nodegraphics"/>\n')
 
-        return buff
+        f.write('<graph edgedefault="directed" id="G">\n')
+
+        for node in self.G.nodes_iter():
+            f.write('<node id="%d">\n' % node)
+            f.write(self.nodes_id[node].get_attributes_gml())
+            f.write('</node>\n')
+
+        for nb, edge in enumerate(self.G.edges_iter()):
+            f.write('<edge id="%d" source="%d" target="%d"/>\n' % (nb, edge[0], edge[1]))
+
+        f.write('</graph>\n')
+        f.write('</graphml>\n')
 
 
 DEFAULT_NODE_TYPE = 'normal'
+
+# the names are written in attribute values
+ATTRIBUTE_ENTITIES = {'"': '&quot;'}
 DEFAULT_NODE_PERM = 0
 DEFAULT_NODE_PERM_LEVEL = -1
 
@@ -1592,6 +1588,9 @@ class NodeF(object):
         else:
             self.label = label
 
+        # the escaped names, built on the first export
+        self.escaped = None
+
         self.attributes = {
             'type': DEFAULT_NODE_TYPE,
             'color': None,
@@ -1608,6 +1607,21 @@ class NodeF(object):
             self.edges[n] = []
             self.edges[n].append(idx)
 
+    def get_escaped(self):
+        """
+            Return the label and the names of the node escaped for xml,
+            escaped once and shared by all the exports
+        """
+        if self.escaped is None:
+            self.escaped = {
+                'label': escape(self.label, ATTRIBUTE_ENTITIES),
+                'class_name': escape(self.class_name, ATTRIBUTE_ENTITIES),
+                'method_name': escape(self.method_name, ATTRIBUTE_ENTITIES),
+                'descriptor': escape(self.descriptor, ATTRIBUTE_ENTITIES),
+                'gml_label': escape(self.class_name + """\n""" + self.method_name + """\n""" + self.descriptor),
+                }
+        return self.escaped
+
     def get_attributes_gexf(self):
         buff = ''
 
@@ -1616,13 +1630,14 @@ class NodeF(object):
                 % (self.attributes['color'][0], self.attributes['color'
                    ][1], self.attributes['color'][2])
 
+        escaped = self.get_escaped()
         buff += '<attvalues>\n'
         buff += '<attvalue id="%d" value="%s"/>\n' \
-            % (ID_ATTRIBUTES['class_name'], escape(self.class_name))
+            % (ID_ATTRIBUTES['class_name'], escaped['class_name'])
         buff += '<attvalue id="%d" value="%s"/>\n' \
-            % (ID_ATTRIBUTES['method_name'], escape(self.method_name))
+            % (ID_ATTRIBUTES['method_name'], escaped['method_name'])
         buff += '<attvalue id="%d" value="%s"/>\n' \
-            % (ID_ATTRIBUTES['descriptor'], escape(self.descriptor))
+            % (ID_ATTRIBUTES['descriptor'], escaped['descriptor'])
 
         if self.attributes['type'] != DEFAULT_NODE_TYPE:
             buff += '<attvalue id="%d" value="%s"/>\n' \
@@ -1664,9 +1679,7 @@ class NodeF(object):
         buff += \
             '<y:NodeLabel alignment="left" autoSizePolicy="content" fontFamily="Dialog" fontSize="13" fontStyle="plain" hasBackgroundColor="false" hasLineColor="false" modelName="internal" modelPosition="c" textColor="#000000" visible="true">\n'
 
-        label = self.class_name + """\n""" + self.method_name \
-            + """\n""" + self.descriptor
-        buff += escape(label)
+        buff += self.get_escaped()['gml_label']
 
         buff += '</y:NodeLabel>\n'
         buff += '</y:ShapeNode>\n'
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import random
+import unittest
+
+PATH_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PATH_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+sys.path.insert(0, PATH_ROOT)
+
+from androguard.core.bytecodes import dvm
+from androguard.core.analysis import analysis
+
+# test/data/classes.dex: LFoo; (an activity), LBar;, LBaz; (extends LBar;),
+# LRecv; (a receiver) and Landroid/support/v4/app/Frag;
+# test/data/classes2.dex: LQux; (extends LBaz;) and LAct2; (extends LFoo;)
+DEX_FILES = ['classes.dex', 'classes2.dex']
+
+
+def get_analysis():
+    vms = []
+    for name in DEX_FILES:
+        with open(os.path.join(PATH_DATA, name), 'rb') as f:
+            vms.append(dvm.DalvikVMFormat(f.read()))
+    vmx = analysis.NewVmAnalysis(vms[0])
+    for vm in vms[1:]:
+        vmx.add(vm)
+    return vms, vmx
+
+
+def get_blocks(vmx):
+    blocks = {}
+    for method, g in vmx.methods.items():
+        blocks[str(method)] = [(b.name, b.start, b.end, b.last_length, b.nb_instructions,
+                                sorted((off, ins.__class__.__name__, ins.get_raw())
+                                       for off, ins in b.special_ins.items()),
+                                [(c[0], c[1], c[2].name, c[3]) for c in b.childs],
+                                [(c[0], c[1], c[2].name, c[3]) for c in b.fathers])
+                               for b in g.basic_blocks.get()]
+    return blocks
+
+
+class IntroProceduralCFGTests(unittest.TestCase):
+
+    def testPoolLayouts(self):
+        _, serial = get_analysis()
+        serial.intro_procedural_cfg(1)
+        _, pooled = get_analysis()
+        pooled.intro_procedural_cfg(2)
+
+        self.assertEqual(get_blocks(serial), get_blocks(pooled))
+        self.assertGreater(len(get_blocks(serial)), 0)
+
+    def testPoolAnalyze(self):
+        _, serial = get_analysis()
+        serial.analyze(xref=False, processes=1)
+        _, pooled = get_analysis()
+        pooled.analyze(xref=False, processes=2)
+
+        # the methods without code only have an empty MethodAnalysis in the pool
+        blocks = dict((k, v) for k, v in get_blocks(pooled).items() if v)
+        self.assertEqual(get_blocks(serial), blocks)
+        self.assertEqual(serial.export_to_dot(), pooled.export_to_dot())
+
+
+def get_block_instructions(block):
+    # the linear scan of the method
+    instructions = []
+    idx = 0
+    for i in block.get_method().get_instructions():
+        if block.get_start() <= idx < block.get_end():
+            instructions.append(i)
+        idx += i.get_length()
+    return instructions
+
+
+def get_outputs(instructions):
+    return [(i.get_name(), i.get_output(), i.get_length()) for i in instructions]
+
+
+class BasicBlocksTests(unittest.TestCase):
+
+    def testInstructions(self):
+        _, vmx = get_analysis()
+        vmx.analyze(xref=False, processes=1)
+
+        nb = 0
+        for g in vmx.methods.values():
+            for block in g.basic_blocks.get():
+                self.assertEqual(get_outputs(block.get_instructions()),
+                                 get_outputs(get_block_instructions(block)))
+                nb += len(block.get_instructions())
+        self.assertGreater(nb, 0)
+
+    def testInstructionsNewBuffer(self):
+        _, vmx = get_analysis()
+        vmx.analyze(xref=False, processes=1)
+
+        g = max(vmx.methods.values(), key=lambda g: len(g.basic_blocks.gets()))
+        block = g.basic_blocks.get_basic_block_pos(0)
+        first = block.get_instructions()
+
+        self.assertEqual([id(i) for i in first], [id(i) for i in block.get_instructions()])
+
+        # a new buffer is a new decoding
+        code = block.get_method().get_code().get_bc()
+        code.set_insn(str(bytearray(code.get_insn())))
+        second = block.get_instructions()
+        self.assertNotEqual([id(i) for i in first], [id(i) for i in second])
+        self.assertEqual(get_outputs(first), get_outputs(second))
+
+
+class ClassHierarchyTests(unittest.TestCase):
+
+    def testRename(self):
+        vms, vmx = get_analysis()
+        self.assertTrue(vmx.ancestor_class('LQux;', 'LBar;'))
+        hierarchy = vmx.get_class_hierarchy()
+
+        vms[0].get_class('LBar;').set_name('LRenamed;')
+        self.assertIsNot(vmx.get_class_hierarchy(), hierarchy)
+        self.assertIsNone(vmx.get_class_hierarchy().get_class('LBar;'))
+        self.assertEqual(vmx.get_class_hierarchy().get_superclass('LBaz;'), 'LRenamed;')
+        self.assertTrue(vmx.ancestor_class('LQux;', 'LRenamed;'))
+        self.assertFalse(vmx.ancestor_class('LQux;', 'LBar;'))
+
+    def testRenameAddedDex(self):
+        vms, vmx = get_analysis()
+        self.assertTrue(vmx.ancestor_class('LQux;', 'LBaz;'))
+
+        # a class of the dex file given to add
+        vms[1].get_class('LQux;').set_name('LQux2;')
+        self.assertTrue(vmx.ancestor_class('LQux2;', 'LBar;'))
+        self.assertFalse(vmx.ancestor_class('LQux;', 'LBaz;'))
+
+    def testAdd(self):
+        vms, _ = get_analysis()
+        vmx = analysis.NewVmAnalysis(vms[0])
+        self.assertFalse(vmx.ancestor_class('LQux;', 'LBar;'))
+
+        vmx.add(vms[1])
+        self.assertTrue(vmx.ancestor_class('LQux;', 'LBar;'))
+        self.assertTrue(vmx.ancestor_class('LAct2;', 'LFoo;'))
+
+
+class Block(object):
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.exception_analysis = 'unset'
+
+    def set_exception_analysis(self, exception_analysis):
+        self.exception_analysis = exception_analysis
+
+
+class TryRange(object):
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class ExceptionsTests(unittest.TestCase):
+
+    def assertSameAsScan(self, cuts, ranges):
+        blocks = analysis.BasicBlocks()
+        for start, end in zip(cuts, cuts[1:]):
+            blocks.push(Block(start, end))
+        exceptions = analysis.Exceptions()
+        exceptions.exceptions = [TryRange(start, end) for start, end in ranges]
+
+        exceptions.set_exception_analysis(blocks)
+        for bb in blocks.get():
+            # the linear scan
+            self.assertIs(bb.exception_analysis, exceptions.get_exception(bb.start, bb.end - 1))
+        return [bb.exception_analysis for bb in blocks.get()]
+
+    def testNested(self):
+        cuts = [0, 4, 8, 12, 16, 20, 24]
+        ranges = [(0, 23), (4, 15), (8, 11)]
+        found = self.assertSameAsScan(cuts, ranges)
+        # the outer try is the first one which contains each block
+        self.assertEqual([(e.start, e.end) for e in found], [(0, 23)] * 6)
+
+        # the inner try first
+        found = self.assertSameAsScan(cuts, ranges[::-1])
+        self.assertEqual([(e.start, e.end) for e in found],
+                         [(0, 23), (4, 15), (8, 11), (4, 15), (0, 23), (0, 23)])
+
+    def testOverlapping(self):
+        cuts = [0, 4, 8, 12, 16, 20]
+        # a try which only overlaps a block is not the one of the block
+        found = self.assertSameAsScan(cuts, [(2, 9), (6, 17)])
+        self.assertEqual([e and (e.start, e.end) for e in found],
+                         [None, (2, 9), (6, 17), (6, 17), None])
+
+        # a try inside a block comes before one which contains the block
+        found = self.assertSameAsScan([0, 10, 20], [(0, 19), (12, 14)])
+        self.assertEqual([(e.start, e.end) for e in found], [(0, 19), (0, 19)])
+        found = self.assertSameAsScan([0, 10, 20], [(12, 14), (0, 19)])
+        self.assertEqual([(e.start, e.end) for e in found], [(0, 19), (12, 14)])
+
+    def testRandom(self):
+        rand = random.Random(0)
+        for _ in xrange(2000):
+            cuts = [0] + sorted(rand.sample(xrange(1, 200), rand.randint(1, 30)))
+            ranges = []
+            for _ in xrange(rand.randint(0, 12)):
+                start = rand.randint(0, 199)
+                ranges.append((start, rand.randint(start, 210)))
+            self.assertSameAsScan(cuts, ranges)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import struct
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+PATH_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PATH_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+sys.path.insert(0, PATH_ROOT)
+
+from androguard.core.bytecodes import apk
+from androguard.core.bytecodes import dvm
+
+NO_INDEX = 0xFFFFFFFF
+
+
+def get_string_pool(strings):
+    offsets = ''
+    chars = ''
+    for s in strings:
+        offsets += struct.pack('<I', len(chars))
+        chars += struct.pack('<H', len(s)) + s.encode('utf-16-le') + '\0\0'
+    chars += '\0' * (-len(chars) % 4)
+
+    header_size = 28
+    return struct.pack('<IIIIIII', apk.CHUNK_STRINGPOOL_TYPE, header_size + len(offsets) + len(chars),
+                       len(strings), 0, 0, header_size + len(offsets), 0) + offsets + chars
+
+
+def get_manifest(package, permissions):
+    """
+        Return a binary AndroidManifest.xml with a package and some uses-permission
+    """
+    strings = [u'android', apk.NS_ANDROID_URI, u'manifest', u'package', package,
+               u'uses-permission', u'name'] + list(permissions)
+
+    def start_tag(name, attributes):
+        data = struct.pack('<IIII', NO_INDEX, name, 0x00140014, len(attributes)) + struct.pack('<I', 0)
+        for ns, attr, value in attributes:
+            data += struct.pack('<IIIII', ns, attr, value, (apk.TYPE_STRING << 24) | 8, value)
+        return struct.pack('<IIII', apk.CHUNK_XML_START_TAG, 16 + len(data), 1, NO_INDEX) + data
+
+    def end_tag(name):
+        return struct.pack('<IIIIII', apk.CHUNK_XML_END_TAG, 24, 1, NO_INDEX, NO_INDEX, name)
+
+    body = struct.pack('<IIIIII', apk.CHUNK_XML_START_NAMESPACE, 24, 1, NO_INDEX, 0, 1)
+    body += start_tag(2, [(NO_INDEX, 3, 4)])
+    for n in xrange(len(permissions)):
+        body += start_tag(5, [(1, 6, 7 + n)])
+        body += end_tag(5)
+    body += end_tag(2)
+    body += struct.pack('<IIIIII', apk.CHUNK_XML_END_NAMESPACE, 24, 1, NO_INDEX, 0, 1)
+
+    body = get_string_pool(strings) + body
+    return struct.pack('<II', apk.CHUNK_AXML_FILE, 8 + len(body)) + body
+
+
+class MappedAPKTests(unittest.TestCase):
+
+    PACKAGE = u'com.example.test'
+    PERMISSIONS = [u'android.permission.INTERNET', u'android.permission.READ_SMS']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.apk')
+        self.manifest = get_manifest(self.PACKAGE, self.PERMISSIONS)
+        self.dex = []
+        with zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_STORED) as z:
+            z.writestr('AndroidManifest.xml', self.manifest)
+            for name in ['classes.dex', 'classes2.dex']:
+                with open(os.path.join(PATH_DATA, name), 'rb') as f:
+                    self.dex.append(f.read())
+                z.writestr(name, self.dex[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testManifest(self):
+        for mapped in (False, True):
+            a = apk.APK(self.filename, mapped=mapped)
+            self.assertTrue(a.is_valid_apk())
+            self.assertEqual(a.get_package(), self.PACKAGE)
+            self.assertEqual(a.get_permissions(), self.PERMISSIONS)
+
+            # the stored manifest is a string in both modes
+            manifest = a.get_file('AndroidManifest.xml')
+            self.assertIs(type(manifest), str)
+            self.assertEqual(manifest, self.manifest)
+            self.assertEqual(apk.AXMLPrinter(manifest).get_buff(), a.get_android_manifest_axml().get_buff())
+
+    def testDex(self):
+        a = apk.APK(self.filename)
+        self.assertEqual(list(a.get_all_dex()), self.dex)
+
+        mapped = apk.APK(self.filename, mapped=True)
+        dex = list(mapped.get_all_dex())
+        self.assertEqual([type(d) for d in dex], [buffer, buffer])
+        self.assertEqual([str(d) for d in dex], self.dex)
+        self.assertIs(type(mapped.get_file('classes.dex')), str)
+
+        self.assertEqual([c.get_name() for c in dvm.DalvikVMFormat(dex[0]).get_classes()],
+                         [c.get_name() for c in dvm.DalvikVMFormat(self.dex[0]).get_classes()])
+
+    def testFileNotPresent(self):
+        a = apk.APK(self.filename, mapped=True)
+        self.assertRaises(apk.FileNotPresent, a.get_file, 'resources.arsc')
+        self.assertRaises(apk.FileNotPresent, a.get_file_buffer, 'resources.arsc')
+
+
+if __name__ == '__main__':
+    unittest.main()
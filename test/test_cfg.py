@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import imp
+import time
+import shutil
+import tempfile
+import unittest
+
+PATH_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PATH_ROOT)
+
+from androguard.core.bytecodes import dvm
+
+# cfg.py is shadowed by the cfg package
+cfg_driver = imp.load_source('cfg_driver', os.path.join(PATH_ROOT, 'cfg.py'))
+
+
+def fake_analysis(base_path, compress=False, binary=False, cache_dir=None):
+    name = os.path.basename(base_path)
+    if name.startswith('hang'):
+        # the bare except of get_instruction swallows any exception raised
+        # in the analysis, the timeout must not rely on one
+        while True:
+            dvm.get_instruction(None, 0x6e, '')
+    if name.startswith('crash'):
+        os._exit(1)
+    with open(base_path[:-3] + 'dot', 'w') as f:
+        f.write(str(os.getpid()))
+
+
+class BatchAnalysisTests(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.base_dir, 'apks'))
+        self.analysis = cfg_driver.one_apk_file_analysis
+        cfg_driver.one_apk_file_analysis = fake_analysis
+
+    def tearDown(self):
+        cfg_driver.one_apk_file_analysis = self.analysis
+        shutil.rmtree(self.base_dir)
+
+    def add_apks(self, *names):
+        for name in names:
+            open(os.path.join(self.base_dir, 'apks', name), 'w').close()
+
+    def get_output(self, name):
+        output = os.path.join(self.base_dir, 'apks', name[:-3] + 'dot')
+        if os.path.isfile(output):
+            with open(output) as f:
+                return f.read()
+        return None
+
+    def testTimeoutInsideGetInstruction(self):
+        self.add_apks('hang.apk', 'a.apk', 'b.apk')
+        start = time.time()
+        cfg_driver.many_apk_file_analysis(self.base_dir, jobs=1, timeout=1)
+        self.assertLess(time.time() - start, 10)
+        self.assertIsNone(self.get_output('hang.apk'))
+        self.assertIsNotNone(self.get_output('a.apk'))
+        self.assertIsNotNone(self.get_output('b.apk'))
+
+    def testCrashedWorker(self):
+        self.add_apks('crash.apk', 'a.apk', 'b.apk')
+        cfg_driver.many_apk_file_analysis(self.base_dir, jobs=2, timeout=10)
+        self.assertIsNone(self.get_output('crash.apk'))
+        self.assertIsNotNone(self.get_output('a.apk'))
+        self.assertIsNotNone(self.get_output('b.apk'))
+
+    def testMaxTasksPerChild(self):
+        names = ['%d.apk' % i for i in range(6)]
+        self.add_apks(*names)
+        cfg_driver.many_apk_file_analysis(self.base_dir, jobs=2, maxtasksperchild=1)
+        pids = set(self.get_output(name) for name in names)
+        self.assertNotIn(None, pids)
+        self.assertEqual(len(pids), len(names))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+PATH_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PATH_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+sys.path.insert(0, PATH_ROOT)
+
+from androguard.core import bytecode
+from androguard.core.androconf import CONF
+from androguard.core.bytecodes import dvm
+
+
+def get_dvm(name='classes.dex'):
+    with open(os.path.join(PATH_DATA, name), 'rb') as f:
+        return dvm.DalvikVMFormat(f.read())
+
+
+def get_names(code):
+    return [(i.get_name(), i.get_output()) for i in code.get_instructions()]
+
+
+class InstructionsCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.size = CONF["INSTRUCTIONS_CACHE_SIZE"]
+        CONF["INSTRUCTIONS_CACHE_SIZE"] = None
+        self.vm = get_dvm()
+        self.cache = self.vm.CM.get_instructions_cache()
+        self.codes = [m.get_code().get_bc() for m in self.vm.get_methods() if m.get_code()]
+
+    def tearDown(self):
+        CONF["INSTRUCTIONS_CACHE_SIZE"] = self.size
+
+    def testHitsMisses(self):
+        code = self.codes[0]
+        first = list(code.get_instructions())
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        self.assertEqual(self.cache.nb_instructions, len(first))
+
+        second = list(code.get_instructions())
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.get_hit_rate(), 0.5)
+        # the same decoded objects
+        self.assertEqual([id(i) for i in first], [id(i) for i in second])
+
+        self.cache.clear()
+        self.assertEqual(self.cache.nb_instructions, 0)
+        list(code.get_instructions())
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def testSetInsn(self):
+        code = self.codes[0]
+        expected = get_names(code)
+        first = list(code.get_instructions())
+
+        code.set_insn(code.get_insn())
+        self.assertEqual(self.cache.nb_instructions, 0)
+        second = list(code.get_instructions())
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertNotEqual([id(i) for i in first], [id(i) for i in second])
+        self.assertEqual(get_names(code), expected)
+
+    def testSetIdx(self):
+        code = self.codes[0]
+        list(code.get_instructions())
+
+        code.set_idx(code.idx)
+        self.assertEqual(self.cache.nb_instructions, 0)
+        list(code.get_instructions())
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def testBudget(self):
+        sizes = [len(list(code.get_instructions())) for code in self.codes]
+        self.assertEqual(self.cache.nb_instructions, sum(sizes))
+
+        # only the most recently used methods fit in the budget
+        self.cache.clear()
+        self.cache.max_instructions = sizes[-1] + sizes[-2]
+        for code in self.codes:
+            list(code.get_instructions())
+        self.assertEqual(self.cache.nb_instructions, sizes[-1] + sizes[-2])
+
+        hits = self.cache.hits
+        list(self.codes[-1].get_instructions())
+        self.assertEqual(self.cache.hits, hits + 1)
+        list(self.codes[0].get_instructions())
+        self.assertEqual(self.cache.hits, hits + 1)
+
+    def testDisabled(self):
+        CONF["INSTRUCTIONS_CACHE_SIZE"] = 0
+        vm = get_dvm()
+        cache = vm.CM.get_instructions_cache()
+        self.assertFalse(cache.is_enabled())
+
+        code = [m.get_code().get_bc() for m in vm.get_methods() if m.get_code()][0]
+        self.assertEqual(get_names(code), get_names(code))
+        self.assertEqual((cache.hits, cache.misses, cache.nb_instructions), (0, 0, 0))
+
+
+def get_mutf8(s):
+    """
+        Return the size in UTF-16 code units and the MUTF-8 encoding of a string
+    """
+    units = []
+    for c in s:
+        o = ord(c)
+        if o > 0xffff:
+            o -= 0x10000
+            units.extend([0xd800 | o >> 10, 0xdc00 | o & 0x3ff])
+        else:
+            units.append(o)
+
+    data = ''
+    for u in units:
+        if 0 < u < 0x80:
+            data += chr(u)
+        elif u < 0x800:
+            data += chr(0xc0 | u >> 6) + chr(0x80 | u & 0x3f)
+        else:
+            data += chr(0xe0 | u >> 12) + chr(0x80 | u >> 6 & 0x3f) + chr(0x80 | u & 0x3f)
+    return len(units), data
+
+
+class StringDataItemTests(unittest.TestCase):
+
+    STRINGS = [u'abc', u'h\xe9llo w\xf6rld', u'a\x00b', u'\u20ac 5', u'\U0001f600!', u'', u'end']
+
+    def get_items(self, raw=lambda data: data):
+        data = ''
+        for s in self.STRINGS:
+            size, encoded = get_mutf8(s)
+            data += dvm.writeuleb128(size) + encoded + '\0'
+
+        vm = get_dvm()
+        buff = bytecode._Bytecode(raw(data))
+        items = [dvm.StringDataItem(buff, vm.CM) for _ in self.STRINGS]
+        self.assertEqual(buff.get_idx(), len(data))
+        return items
+
+    def get_expected(self, s):
+        size, encoded = get_mutf8(s)
+        return dvm.utf8_to_string(bytecode.BuffHandle(encoded), size)
+
+    def testGet(self):
+        for raw in (str, buffer):
+            items = self.get_items(raw)
+            # only the ascii strings are read when the item is parsed
+            self.assertEqual([i.data is None for i in items],
+                             [any(c == u'\x00' or ord(c) >= 0x80 for c in s) for s in self.STRINGS])
+
+            # the strings are decoded in any order
+            for item, s in reversed(zip(items, self.STRINGS)):
+                self.assertEqual(item.get(), self.get_expected(s))
+                self.assertEqual(item.get_utf16_size(), get_mutf8(s)[0])
+
+            self.assertEqual([i.get() for i in items[:4]],
+                             [s.encode('utf-8') for s in self.STRINGS[:4]])
+
+    def testRaw(self):
+        for item, s in zip(self.get_items(), self.STRINGS):
+            size, encoded = get_mutf8(s)
+            self.assertEqual(item.get_raw(), dvm.writeuleb128(size) + self.get_expected(s))
+
+    def testDex(self):
+        vm = get_dvm()
+        self.assertIn(u'h\xe9llo w\xf6rld'.encode('utf-8'), vm.get_strings())
+
+
+if __name__ == '__main__':
+    unittest.main()
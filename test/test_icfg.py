@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import collections
+import cStringIO
+
+PATH_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PATH_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+sys.path.insert(0, PATH_ROOT)
+
+from androguard.core.bytecodes import dvm
+from androguard.core.analysis import analysis
+from androguard.core.analysis.icfg import CompactICFG, EDGE_KINDS, EDGE_INTRA, EDGE_INTER
+
+
+def get_analysis():
+    vms = []
+    for name in ['classes.dex', 'classes2.dex']:
+        with open(os.path.join(PATH_DATA, name), 'rb') as f:
+            vms.append(dvm.DalvikVMFormat(f.read()))
+    vmx = analysis.NewVmAnalysis(vms[0])
+    for vm in vms[1:]:
+        vmx.add(vm)
+    vmx.analyze(xref=False, processes=1)
+    return vmx
+
+
+def get_blocks(vmx):
+    for vm in vmx.get_vms():
+        for method in vm.get_methods(vmx.framework_classes):
+            g = vmx.methods.get(method)
+            if g is None:
+                continue
+            for blocks in (g.basic_blocks, g.frame_blocks):
+                for block in blocks.get():
+                    yield block
+
+
+def get_list_edges(vmx):
+    # the edges of the list graph, by name
+    return [(block.name, child[2].name, EDGE_KINDS[child[3]])
+            for block in get_blocks(vmx) for child in block.childs]
+
+
+def get_compact_edges(graph, edges):
+    return [(graph.get_name(src), graph.get_name(dst), kind) for src, dst, kind in edges]
+
+
+class CompactICFGTests(unittest.TestCase):
+
+    def setUp(self):
+        self.vmx = get_analysis()
+        self.graph = self.vmx.get_compact_icfg()
+        self.edges = get_list_edges(self.vmx)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assertSameGraph(self, graph, other):
+        self.assertEqual(graph.names, other.names)
+        self.assertEqual(list(graph.edges()), list(other.edges()))
+        for n in graph.nodes():
+            self.assertEqual(list(graph.predecessors(n)), list(other.predecessors(n)))
+
+    def testEdges(self):
+        self.assertGreater(len(self.edges), 0)
+        self.assertEqual(self.graph.get_nb_edges(), len(self.edges))
+        self.assertEqual(collections.Counter(get_compact_edges(self.graph, self.graph.edges())),
+                         collections.Counter(self.edges))
+        self.assertEqual(collections.Counter(get_compact_edges(self.graph, self.graph.edges(EDGE_INTER))),
+                         collections.Counter(e for e in self.edges if e[2] == EDGE_INTER))
+
+    def testSuccessors(self):
+        for block in get_blocks(self.vmx):
+            node = self.graph.get_id(block.name)
+            self.assertEqual([(self.graph.get_name(dst), kind) for dst, kind in self.graph.successors(node)],
+                             [(child[2].name, EDGE_KINDS[child[3]]) for child in block.childs])
+
+    def testPredecessors(self):
+        fathers = collections.defaultdict(list)
+        for src, dst, kind in self.edges:
+            fathers[dst].append((src, kind))
+
+        for n in self.graph.nodes():
+            name = self.graph.get_name(n)
+            self.assertEqual(sorted((self.graph.get_name(src), kind) for src, kind in self.graph.predecessors(n)),
+                             sorted(fathers[name]))
+
+        # the fathers of the blocks are the intra-procedural edges
+        for block in get_blocks(self.vmx):
+            node = self.graph.get_id(block.name)
+            self.assertEqual(sorted(self.graph.get_name(src) for src, _ in self.graph.predecessors(node, EDGE_INTRA)),
+                             sorted(father[2].name for father in block.fathers))
+
+    def testRelease(self):
+        graph = self.vmx.get_compact_icfg(release=True)
+        self.assertSameGraph(self.graph, graph)
+        for block in get_blocks(self.vmx):
+            self.assertEqual((block.childs, block.fathers), ([], []))
+
+    def testSaveLoad(self):
+        filename = os.path.join(self.tmp_dir, 'test.icfg')
+        self.graph.save(filename)
+        graph = CompactICFG.load(filename)
+        self.assertSameGraph(self.graph, graph)
+        self.assertEqual(graph.get_nb_nodes(), self.graph.get_nb_nodes())
+        self.assertEqual(graph.export_to_dot(), self.graph.export_to_dot())
+
+        # a loaded graph is saved again as it has been loaded
+        other = os.path.join(self.tmp_dir, 'other.icfg')
+        CompactICFG.load(filename).save(other)
+        with open(filename, 'rb') as f, open(other, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    def testLoadInvalid(self):
+        filename = os.path.join(self.tmp_dir, 'test.icfg')
+        self.graph.save(filename)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        with open(filename, 'wb') as f:
+            f.write(data[:len(data) / 2])
+        self.assertRaises(ValueError, CompactICFG.load, filename)
+
+    def testWriteGexf(self):
+        buff = cStringIO.StringIO()
+        self.graph.write_gexf(buff)
+        self.assertEqual(buff.getvalue(), self.graph.export_to_gexf())
+        self.assertEqual(buff.getvalue().count('<edge '), len(self.edges))
+        self.assertEqual(buff.getvalue().count('<node '), self.graph.get_nb_nodes())
+
+
+if __name__ == '__main__':
+    unittest.main()
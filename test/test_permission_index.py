@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import importlib
+import cStringIO
+
+PATH_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PATH_ROOT)
+
+from androguard.core.api_specific_resources import permission_index
+from androguard.core.api_specific_resources.permission_index import PermissionIndex, INDEX_TABLES
+
+
+class PermissionIndexTests(unittest.TestCase):
+
+    TABLE = {u'Landroid/a;-b-()V': ['android.permission.A'],
+             'Landroid/c;-d-(I)V': ['android.permission.B', 'android.permission.C'],
+             'Landroid/c;-e-()V': [],
+             u'Lcom/\xe9;-f-()V': ['android.permission.D']}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_index(self, table):
+        path = os.path.join(self.tmp_dir, 'table.idx')
+        permission_index.build_index(table, path)
+        return PermissionIndex(path)
+
+    def testLookups(self):
+        index = self.get_index(self.TABLE)
+        self.assertEqual(len(index), len(self.TABLE))
+        for key, value in self.TABLE.items():
+            self.assertIn(key, index)
+            self.assertTrue(index.has_key(key))
+            self.assertEqual(index[key], value)
+            self.assertEqual(index.get(key), value)
+        # the unicode and the utf-8 keys are the same
+        self.assertEqual(index[u'Lcom/\xe9;-f-()V'.encode('utf-8')], ['android.permission.D'])
+
+        for key in ['', 'Landroid/a;', 'Landroid/c;-d-(I)VV', 'Lz;']:
+            self.assertNotIn(key, index)
+            self.assertIsNone(index.get(key))
+            self.assertEqual(index.get(key, []), [])
+            self.assertRaises(KeyError, index.__getitem__, key)
+
+    def testDict(self):
+        index = self.get_index(self.TABLE)
+        table = dict((k.encode('utf-8') if isinstance(k, unicode) else k, v) for k, v in self.TABLE.items())
+
+        self.assertEqual(list(index), sorted(table))
+        self.assertEqual(index.keys(), sorted(table))
+        self.assertEqual(list(index.iterkeys()), sorted(table))
+        self.assertEqual(index.values(), [table[k] for k in sorted(table)])
+        self.assertEqual(list(index.itervalues()), [table[k] for k in sorted(table)])
+        self.assertEqual(index.items(), sorted(table.items()))
+        self.assertEqual(index.copy(), table)
+        self.assertEqual(index, table)
+
+    def testEmpty(self):
+        index = self.get_index({})
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.copy(), {})
+        self.assertIsNone(index.get('Landroid/a;-b-()V'))
+
+    def testInvalid(self):
+        path = os.path.join(self.tmp_dir, 'table.idx')
+        with open(path, 'wb') as f:
+            f.write('XXXX' + '\0' * 8)
+        self.assertRaises(ValueError, PermissionIndex, path)
+
+    def testLoadTable(self):
+        module_name = sorted(INDEX_TABLES)[0]
+        table = INDEX_TABLES[module_name][0]
+
+        # no index file: the dict of the module
+        value = permission_index.load_table(module_name, table, self.tmp_dir)
+        self.assertIs(value, getattr(importlib.import_module(module_name), table))
+
+        # an invalid index file is not used either
+        with open(permission_index.get_index_path(module_name, table, self.tmp_dir), 'wb') as f:
+            f.write('XXXX' + '\0' * 8)
+        self.assertIs(permission_index.load_table(module_name, table, self.tmp_dir), value)
+
+    def testBuildAll(self):
+        stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            permission_index.build_all(self.tmp_dir)
+        finally:
+            sys.stdout = stdout
+
+        for module_name in sorted(INDEX_TABLES):
+            module = importlib.import_module(module_name)
+            for table in INDEX_TABLES[module_name]:
+                index = permission_index.load_table(module_name, table, self.tmp_dir)
+                self.assertIsInstance(index, PermissionIndex)
+
+                value = getattr(module, table)
+                self.assertEqual(len(index), len(value))
+                self.assertEqual(index.copy(), value)
+                for key in sorted(value)[::97]:
+                    self.assertEqual(index[key], value[key])
+                index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
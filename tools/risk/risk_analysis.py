@@ -76,29 +76,14 @@ def main(options):
 
 def create_xref(self):
         for last_vm in self.vms:
-            for current_class in last_vm.get_classes():
-                for current_method in current_class.get_methods():
-                    code = current_method.get_code()
-                    if code is None:
-                        continue
-
-                    off = 0
-                    bc = code.get_bc()
-                    try:
-                        for instruction in bc.get_instructions():
-                            op_value = instruction.get_op_value()
-
-                            # invoke-kind /range {vC, vD, vE, vF, vG}, meth@BBBB
-                            if (0x6e <= op_value <= 0x72) or (0x74 <= op_value <= 0x78):
-                                idx_meth = instruction.get_ref_kind()
-                                method_info = last_vm.get_cm_method(idx_meth)
-                                if method_info:
-                                    if method_info[1] in risk_APIs.keys():
-                                        yield risk_APIs[method_info[1]]
-
-                            off += instruction.get_length()
-                    except dvm.InvalidInstruction as e:
-                        warning("Invalid instruction %s" % str(e))
+            # in the order of the methods and of their instructions
+            for current_method, off, idx_meth, op_value in last_vm.get_call_sites().gets():
+                # invoke-kind /range {vC, vD, vE, vF, vG}, meth@BBBB
+                if (0x6e <= op_value <= 0x72) or (0x74 <= op_value <= 0x78):
+                    method_info = last_vm.get_cm_method(idx_meth)
+                    if method_info:
+                        if method_info[1] in risk_APIs.keys():
+                            yield risk_APIs[method_info[1]]
 
 
 if __name__ == '__main__':